@@ -1,146 +1,546 @@
 import re
-from collections import defaultdict
+from array import array
+from collections import OrderedDict, defaultdict
+import argparse
+import asyncio
+import atexit
+import inspect
+import json
+import mmap
+import multiprocessing
 import os
+import pickle
+import random
+import shutil
+import struct
 import sys
-import copy
-
+import time
 
 sq_pattern = re.compile(r"^[a-h][1-8]$", re.IGNORECASE)
+san_pattern = re.compile(r"^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$")
+tag_pattern = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$')
+movetext_noise = re.compile(r"\{[^}]*\}|;[^\n]*|\$\d+|\d+\.(?:\.\.)?")
+
+# Squares are indexed 0-63 from a1 to h8: file = square & 7, rank = square >> 3
+SQUARES = [c + r for r in "12345678" for c in "abcdefgh"]
+
+
+def square_index(name: str) -> int:
+    return (int(name[1]) - 1) * 8 + ord(name[0].lower()) - ord("a")
+
+
+def square_name(square: int) -> str:
+    return SQUARES[square]
+
+
+KNIGHT_JUMPS = ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))
+ROOK_DIRECTIONS = ((0, 1), (1, 0), (0, -1), (-1, 0))
+BISHOP_DIRECTIONS = ((1, 1), (1, -1), (-1, -1), (-1, 1))
+KING_STEPS = ROOK_DIRECTIONS + BISHOP_DIRECTIONS
+DARK_SQUARES = sum(
+    1 << square for square in range(64) if (square + (square >> 3)) % 2 == 0
+)
+
+
+def jump_targets(square: int, steps) -> list:
+    col, row = square & 7, square >> 3
+    return [
+        (row + drow) * 8 + col + dcol
+        for dcol, drow in steps
+        if 0 <= col + dcol < 8 and 0 <= row + drow < 8
+    ]
+
+
+def ray_squares(square: int, dcol: int, drow: int) -> list:
+    ray = []
+    col, row = (square & 7) + dcol, (square >> 3) + drow
+    while 0 <= col < 8 and 0 <= row < 8:
+        ray.append(row * 8 + col)
+        col += dcol
+        row += drow
+    return ray
+
+
+# Attack tables, built once: target lists and bitboards for every square
+KNIGHT_TARGETS = [jump_targets(square, KNIGHT_JUMPS) for square in range(64)]
+KING_TARGETS = [jump_targets(square, KING_STEPS) for square in range(64)]
+KNIGHT_ATTACKS = [sum(1 << t for t in targets) for targets in KNIGHT_TARGETS]
+KING_ATTACKS = [sum(1 << t for t in targets) for targets in KING_TARGETS]
+PAWN_ATTACKS = {  # squares attacked by a pawn of that color standing on the square
+    "white": [
+        sum(1 << t for t in jump_targets(sq, ((-1, 1), (1, 1)))) for sq in range(64)
+    ],
+    "black": [
+        sum(1 << t for t in jump_targets(sq, ((-1, -1), (1, -1)))) for sq in range(64)
+    ],
+}
+# RAYS[square] holds the 4 straight rays followed by the 4 diagonal ones
+RAYS = [[ray_squares(square, dc, dr) for dc, dr in KING_STEPS] for square in range(64)]
+RAY_MASKS = [[sum(1 << t for t in ray) for ray in rays] for rays in RAYS]
+ROOK_RAYS = [rays[:4] for rays in RAYS]
+BISHOP_RAYS = [rays[4:] for rays in RAYS]
+# Castling rights that survive a move from or to each square (K=1, Q=2, k=4, q=8)
+CASTLING_KEPT = [15] * 64
+CASTLING_KEPT[0], CASTLING_KEPT[4], CASTLING_KEPT[7] = 13, 12, 14
+CASTLING_KEPT[56], CASTLING_KEPT[60], CASTLING_KEPT[63] = 7, 3, 11
 
 
 class Chessboard:
-    en_passant = False
+    ep_square = None  # square a pawn may take en passant on, after a double push
+    castling = 0  # K=1, Q=2, k=4, q=8
     check = False
+    white_turn = True
+    halfmove_clock = 0
+    fullmove_number = 1
 
     def __init__(self):
-        squares = defaultdict()
-        rows = ["1", "2", "3", "4", "5", "6", "7", "8"]
-        columns = ["a", "b", "c", "d", "e", "f", "g", "h"]
-        for c in columns:
-            for r in rows:
-                squares[c + r] = " "
-        self.squares = squares
+        self.squares = [" "] * 64
+        self.bitboards = {"white": defaultdict(int), "black": defaultdict(int)}
+        self.occupied = {"white": 0, "black": 0}
+        self.pieces = {"white": set(), "black": set()}  # squares of the live pieces
+        self.king_square = {"white": None, "black": None}
+        self.material = {"white": 0, "black": 0}  # sum of valore
+        self.score = {"white": 0, "black": 0}  # centipawns with piece-square bonus
+        self.history = []
+        self.zobrist_key = 0
+
+    @property
+    def key(self) -> int:
+        return self.zobrist_key
+
+    def __getstate__(self):
+        # Pickles hold the squares and the small state fields, the bitboards,
+        # piece sets, scores and key are rebuilt from them
+        return (
+            self.squares,
+            self.white_turn,
+            self.castling,
+            self.ep_square,
+            self.halfmove_clock,
+            self.fullmove_number,
+            self.check,
+            self.history,
+        )
+
+    def __setstate__(self, state):
+        self.__init__()
+        squares = state[0]
+        (
+            self.white_turn,
+            self.castling,
+            self.ep_square,
+            self.halfmove_clock,
+            self.fullmove_number,
+            self.check,
+            self.history,
+        ) = state[1:]
+        for square, piece in enumerate(squares):
+            if piece != " ":
+                self.put(piece, square)
+        self.zobrist_key = self.compute_key()
+
+    @classmethod
+    def from_fen(cls, fen: str):
+        fields = fen.split()
+        if len(fields) not in (4, 6):
+            raise ValueError("Invalid FEN")
+        placement, side, castling, ep_square = fields[:4]
+        board = cls()
+        ranks = placement.split("/")
+        if len(ranks) != 8:
+            raise ValueError("Invalid FEN")
+        for rank, row in zip(range(7, -1, -1), ranks):  # rank 8 to rank 1
+            file = 0
+            for char in row:
+                if char in "12345678":
+                    file += int(char)
+                elif char.lower() in FEN_PIECES and file < 8:
+                    color = "white" if char.isupper() else "black"
+                    board.put(FEN_PIECES[char.lower()](color), rank * 8 + file)
+                    file += 1
+                else:
+                    raise ValueError("Invalid FEN")
+            if file != 8:
+                raise ValueError("Invalid FEN")
+        for color in ("white", "black"):  # exactly one king of each colour
+            kings = board.bitboards[color][King]
+            if kings == 0 or kings & (kings - 1) != 0:
+                raise ValueError("Invalid FEN")
+        if side not in ("w", "b"):
+            raise ValueError("Invalid FEN")
+        if castling != "-" and castling.strip("KQkq") != "":
+            raise ValueError("Invalid FEN")
+        board.white_turn = side == "w"
+        if len(fields) == 6:
+            board.halfmove_clock = int(fields[4])
+            board.fullmove_number = int(fields[5])
+
+        for bit, char, king_pos, rook_pos, color in (
+            (1, "K", 4, 7, "white"),
+            (2, "Q", 4, 0, "white"),
+            (4, "k", 60, 63, "black"),
+            (8, "q", 60, 56, "black"),
+        ):
+            king, rook = board.squares[king_pos], board.squares[rook_pos]
+            if (
+                char in castling
+                and isinstance(king, King)
+                and king.color == color
+                and isinstance(rook, Rook)
+                and rook.color == color
+            ):
+                board.castling |= bit
+
+        if ep_square != "-":  # behind a pawn of the side that just moved
+            if sq_pattern.search(ep_square) == None:
+                raise ValueError("Invalid FEN")
+            if ep_square[1] != ("6" if board.white_turn == True else "3"):
+                raise ValueError("Invalid FEN")
+            board.ep_square = square_index(ep_square)
+        waiting = "black" if board.white_turn == True else "white"
+        if is_attacked(waiting == "white", board.king_square[waiting], board):
+            raise ValueError("Invalid FEN")  # the side to move could take the king
+        board.zobrist_key = board.compute_key()
+        return board
+
+    def to_fen(self) -> str:
+        rows = []
+        for r in range(7, -1, -1):
+            row, empty = "", 0
+            for square in range(r * 8, r * 8 + 8):
+                piece = self.squares[square]
+                if piece == " ":
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                letter = FEN_LETTERS[type(piece)]
+                row += letter.upper() if piece.color == "white" else letter
+            rows.append(row + str(empty) if empty else row)
+
+        castling = "".join(
+            char for bit, char in zip((1, 2, 4, 8), "KQkq") if self.castling & bit
+        )
+        return " ".join(
+            (
+                "/".join(rows),
+                "w" if self.white_turn == True else "b",
+                castling or "-",
+                "-" if self.ep_square == None else square_name(self.ep_square),
+                str(self.halfmove_clock),
+                str(self.fullmove_number),
+            )
+        )
+
+    def compute_key(self) -> int:
+        key = 0
+        for color in ("white", "black"):
+            for square in self.pieces[color]:
+                piece = self.squares[square]
+                key ^= ZOBRIST_PIECES[color][type(piece)][square]
+        key ^= ZOBRIST_CASTLING[self.castling]
+        if self.ep_capturable():
+            key ^= ZOBRIST_EP[self.ep_square & 7]
+        if self.white_turn == False:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        return key
+
+    def ep_capturable(self) -> bool:
+        # The key only holds the en passant file when a pawn can really take
+        if self.ep_square == None:
+            return False
+        color, pushed = ("white", "black") if self.white_turn else ("black", "white")
+        return PAWN_ATTACKS[pushed][self.ep_square] & self.bitboards[color][Pawn] != 0
+
+    def put(self, piece, square: int) -> None:
+        self.squares[square] = piece
+        self.bitboards[piece.color][type(piece)] |= 1 << square
+        self.occupied[piece.color] |= 1 << square
+        self.pieces[piece.color].add(square)
+        if isinstance(piece, King):
+            self.king_square[piece.color] = square
+        else:
+            self.material[piece.color] += piece.valore
+        self.score[piece.color] += PIECE_SQUARE[piece.color][type(piece)][square]
+        self.zobrist_key ^= ZOBRIST_PIECES[piece.color][type(piece)][square]
+
+    def remove(self, square: int):
+        piece = self.squares[square]
+        self.squares[square] = " "
+        self.bitboards[piece.color][type(piece)] &= ~(1 << square)
+        self.occupied[piece.color] &= ~(1 << square)
+        self.pieces[piece.color].discard(square)
+        if not isinstance(piece, King):
+            self.material[piece.color] -= piece.valore
+        self.score[piece.color] -= PIECE_SQUARE[piece.color][type(piece)][square]
+        self.zobrist_key ^= ZOBRIST_PIECES[piece.color][type(piece)][square]
+        return piece
+
+    def make_move(self, move_from: int, move_to: int, promotion=None) -> None:
+        piece = self.squares[move_from]
+        captured = self.squares[move_to]
+        captured_pos = move_to
+        if (
+            isinstance(piece, Pawn)
+            and (move_from & 7) != (move_to & 7)
+            and captured == " "
+        ):  # en passant, the captured pawn stands beside the starting square
+            captured_pos = (move_from & ~7) | (move_to & 7)
+            captured = self.squares[captured_pos]
+
+        rook_from = rook_to = None
+        if isinstance(piece, King) and abs((move_to & 7) - (move_from & 7)) == 2:
+            if move_to > move_from:  # castling short
+                rook_from, rook_to = move_from + 3, move_from + 1
+            else:  # castling long
+                rook_from, rook_to = move_from - 4, move_from - 1
+
+        self.history.append(
+            (
+                move_from,
+                move_to,
+                piece,
+                captured,
+                captured_pos,
+                rook_from,
+                rook_to,
+                self.castling,
+                self.ep_square,
+                promotion,
+                self.zobrist_key,
+                self.halfmove_clock,
+            )
+        )
+        if self.ep_square != None:  # en passant lasts for a single move
+            if self.ep_capturable():
+                self.zobrist_key ^= ZOBRIST_EP[self.ep_square & 7]
+            self.ep_square = None
+        if isinstance(piece, Pawn) or captured != " ":
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if self.white_turn == False:
+            self.fullmove_number += 1
+        self.white_turn = not self.white_turn
+        self.zobrist_key ^= ZOBRIST_BLACK_TO_MOVE
+
+        if captured != " ":
+            self.remove(captured_pos)
+        self.remove(move_from)
+        self.put(piece if promotion == None else promotion, move_to)
+        if rook_from != None:
+            self.put(self.remove(rook_from), rook_to)
+
+        if self.castling:
+            castling = self.castling & CASTLING_KEPT[move_from] & CASTLING_KEPT[move_to]
+            if castling != self.castling:
+                self.zobrist_key ^= ZOBRIST_CASTLING[self.castling]
+                self.zobrist_key ^= ZOBRIST_CASTLING[castling]
+                self.castling = castling
+
+        if isinstance(piece, Pawn) and abs(move_to - move_from) == 16:
+            self.ep_square = (move_from + move_to) >> 1  # the square passed over
+            if self.ep_capturable():
+                self.zobrist_key ^= ZOBRIST_EP[move_to & 7]
+
+    def unmake_move(self) -> None:
+        (
+            move_from,
+            move_to,
+            piece,
+            captured,
+            captured_pos,
+            rook_from,
+            rook_to,
+            self.castling,
+            self.ep_square,
+            promotion,
+            key,
+            self.halfmove_clock,
+        ) = self.history.pop()
+        self.white_turn = not self.white_turn
+        if self.white_turn == False:
+            self.fullmove_number -= 1
+
+        if rook_from != None:
+            self.put(self.remove(rook_to), rook_from)
+        self.remove(move_to)
+        self.put(piece, move_from)
+        if captured != " ":
+            self.put(captured, captured_pos)
+        self.zobrist_key = key
 
     def __str__(self) -> str:
-        return f"""
+        rows = []
+        for r in range(7, -1, -1):
+            rows.append(
+                f"{r + 1} | "
+                + " | ".join(str(self.squares[r * 8 + c]) for c in range(8))
+                + f" | {r + 1}"
+            )
+        return (
+            """
     a   b   c   d   e   f   g   h
    -------------------------------
-8 | {self.squares["a8"]} | {self.squares["b8"]} | {self.squares["c8"]} | {self.squares["d8"]} | {self.squares["e8"]} | {self.squares["f8"]} | {self.squares["g8"]} | {self.squares["h8"]} | 8
-  |--- --- --- --- --- --- --- ---| 
-7 | {self.squares["a7"]} | {self.squares["b7"]} | {self.squares["c7"]} | {self.squares["d7"]} | {self.squares["e7"]} | {self.squares["f7"]} | {self.squares["g7"]} | {self.squares["h7"]} | 7
-  |--- --- --- --- --- --- --- ---|
-6 | {self.squares["a6"]} | {self.squares["b6"]} | {self.squares["c6"]} | {self.squares["d6"]} | {self.squares["e6"]} | {self.squares["f6"]} | {self.squares["g6"]} | {self.squares["h6"]} | 6
-  |--- --- --- --- --- --- --- ---|
-5 | {self.squares["a5"]} | {self.squares["b5"]} | {self.squares["c5"]} | {self.squares["d5"]} | {self.squares["e5"]} | {self.squares["f5"]} | {self.squares["g5"]} | {self.squares["h5"]} | 5
-  |--- --- --- --- --- --- --- ---|
-4 | {self.squares["a4"]} | {self.squares["b4"]} | {self.squares["c4"]} | {self.squares["d4"]} | {self.squares["e4"]} | {self.squares["f4"]} | {self.squares["g4"]} | {self.squares["h4"]} | 4
-  |--- --- --- --- --- --- --- ---|
-3 | {self.squares["a3"]} | {self.squares["b3"]} | {self.squares["c3"]} | {self.squares["d3"]} | {self.squares["e3"]} | {self.squares["f3"]} | {self.squares["g3"]} | {self.squares["h3"]} | 3
-  |--- --- --- --- --- --- --- ---|
-2 | {self.squares["a2"]} | {self.squares["b2"]} | {self.squares["c2"]} | {self.squares["d2"]} | {self.squares["e2"]} | {self.squares["f2"]} | {self.squares["g2"]} | {self.squares["h2"]} | 2
-  |--- --- --- --- --- --- --- ---|
-1 | {self.squares["a1"]} | {self.squares["b1"]} | {self.squares["c1"]} | {self.squares["d1"]} | {self.squares["e1"]} | {self.squares["f1"]} | {self.squares["g1"]} | {self.squares["h1"]} | 1
+"""
+            + "\n  |--- --- --- --- --- --- --- ---|\n".join(rows)
+            + """
    -------------------------------
     a   b   c   d   e   f   g   h              
-              """
+"""
+            + f"    {self.material_balance()}\n              "
+        )
+
+    def repetitions(self) -> int:
+        # Times the position has stood on the board since the last capture or
+        # pawn move, this one included. history holds the key before each move
+        count = 1
+        history = self.history
+        for back in range(2, min(self.halfmove_clock, len(history)) + 1, 2):
+            if history[-back][10] == self.zobrist_key:
+                count += 1
+        return count
+
+    def insufficient_material(self) -> bool:
+        # No sequence of moves can mate: bare kings, a single minor piece, or
+        # bishops that all stand on squares of one colour
+        white, black = self.bitboards["white"], self.bitboards["black"]
+        if white[Pawn] | white[Rook] | white[Queen]:
+            return False
+        if black[Pawn] | black[Rook] | black[Queen]:
+            return False
+        knights = white[Knight] | black[Knight]
+        bishops = white[Bishop] | black[Bishop]
+        if knights == 0 and (
+            bishops & DARK_SQUARES == 0 or bishops & ~DARK_SQUARES == 0
+        ):
+            return True
+        return (knights | bishops).bit_count() <= 1
+
+    def material_balance(self) -> str:
+        balance = self.material["white"] - self.material["black"]
+        if balance == 0:
+            return "Material: even"
+        return f"Material: {'White' if balance > 0 else 'Black'} +{abs(balance)}"
 
 
 class Piece:
+    # One shared, immutable instance per class and colour: the board keeps
+    # where the pieces stand and the castling and en passant state
+    __slots__ = ("color",)
+    instances = {}
+
+    def __new__(cls, color: str):
+        piece = Piece.instances.get((cls, color))
+        if piece == None:
+            if color not in ("black", "white"):
+                raise ValueError("Invalid color")
+            piece = object.__new__(cls)
+            object.__setattr__(piece, "color", color)
+            Piece.instances[(cls, color)] = piece
+        return piece
+
+    def __setattr__(self, name, value):
+        raise AttributeError("pieces are immutable")
+
+    def __reduce__(self):
+        return type(self), (self.color,)
+
+    def step_moves(self, board, targets):
+        for target in targets:
+            if (
+                board.squares[target] == " "
+                or board.squares[target].color != self.color
+            ):
+                yield target
 
-    def __init__(self, color: str, position: str, board: Chessboard):
-        if color.lower() not in ["black", "white"]:
-            raise ValueError("Invalid color")
-        if sq_pattern.search(position) == None:
-            raise ValueError("Invalid position")
-        self.color = color
-        self.position = position
-        self.on_the_board = 1
+    def ray_moves(self, board, rays):
+        for ray in rays:
+            for target in ray:
+                if board.squares[target] != " ":
+                    if board.squares[target].color != self.color:
+                        yield target
+                    break
+                yield target
 
 
 class Pawn(Piece):
+    __slots__ = ()
     valore = 1
-    en_passant = 0
-
-    def __init__(self, color, position, board):
-        super().__init__(color, position, board)
 
     def move(self, start_pos, final_pos, board) -> int:
-        start_col, start_row = start_pos[0], start_pos[1]
-        final_col, final_row = final_pos[0], final_pos[1]
         if self.color == "white":
             mov = 1
-            starting_row = "2"
+            starting_row = 1
         else:
             mov = -1
-            starting_row = "7"
+            starting_row = 6
+        start_col, start_row = start_pos & 7, start_pos >> 3
+        final_col, final_row = final_pos & 7, final_pos >> 3
 
         if (  # normal move, 1 row forward
             start_col == final_col
-            and (int(start_row) + mov == int(final_row))
+            and start_row + mov == final_row
             and board.squares[final_pos] == " "
         ):
             return 1
         elif (  # 2 rows forward if in starting position
             start_col == final_col
             and start_row == starting_row
-            and (int(start_row) + (mov * 2) == int(final_row))
-            and board.squares[start_col + str(int(start_row) + mov)] == " "
+            and start_row + mov * 2 == final_row
+            and board.squares[start_pos + mov * 8] == " "
             and board.squares[final_pos] == " "
         ):
             return 2
         elif (  # diagonal capture
-            int(start_row) + mov == int(final_row)
-            and (
-                (ord(final_col) == ord(start_col) + 1)
-                or (ord(final_col) == ord(start_col) - 1)
-            )
+            start_row + mov == final_row
+            and abs(final_col - start_col) == 1
             and board.squares[final_pos] != " "
+            and board.squares[final_pos].color != self.color
         ):
             return 1
         elif (  # en passant
-            int(start_row) + mov == int(final_row)
-            and (
-                (ord(final_col) == ord(start_col) + 1)
-                or (ord(final_col) == ord(start_col) - 1)
-            )
-            and board.squares[final_pos] == " "
-            and isinstance(board.squares[final_pos[0] + start_pos[1]], Pawn)
-            and board.squares[final_pos[0] + start_pos[1]].en_passant == 1
-            and board.squares[start_pos].en_passant == 1
+            start_row + mov == final_row
+            and abs(final_col - start_col) == 1
+            and final_pos == board.ep_square
+            and final_row == (5 if self.color == "white" else 2)
         ):
             return 3
         else:
             return 0
 
-    def promote(self, position, board) -> Piece:
-        while True:
-            promote = (
-                input("Promote to (N=knight, B=bishop, R=rook, Q=queen): ")
-                .lower()
-                .strip()
-            )
-            if promote in ["n", "b", "r", "q"]:
-                match promote:
-                    case "n":
-                        if position[1] == "8":
-                            return Knight("white", position, board)
-                        else:
-                            return Knight("black", position, board)
-                    case "b":
-                        if position[1] == "8":
-                            return Bishop("white", position, board)
-                        else:
-                            return Bishop("black", position, board)
-                    case "r":
-                        if position[1] == "8":
-                            return Rook("white", position, board)
-                        else:
-                            return Rook("black", position, board)
-                    case "q":
-                        if position[1] == "8":
-                            return Queen("white", position, board)
-                        else:
-                            return Queen("black", position, board)
+    def generate_moves(self, board, square):
+        if self.color == "white":
+            mov = 8
+            starting_row = 1
+        else:
+            mov = -8
+            starting_row = 6
+        forward = square + mov
+        if forward not in range(64):
+            return
+        if board.squares[forward] == " ":
+            yield forward
+            if square >> 3 == starting_row and board.squares[forward + mov] == " ":
+                yield forward + mov
+        for target in (forward - 1, forward + 1):
+            if target >> 3 == forward >> 3 and self.move(
+                square, target, board
+            ):  # diagonal capture or en passant
+                yield target
+
+    def promote(self, promote: str = "q") -> Piece:
+        match promote.lower():
+            case "n":
+                return Knight(self.color)
+            case "b":
+                return Bishop(self.color)
+            case "r":
+                return Rook(self.color)
+            case "q":
+                return Queen(self.color)
+        raise ValueError("Invalid promotion")
 
     def __str__(self) -> str:
         if self.color == "white":
@@ -150,52 +550,21 @@ class Pawn(Piece):
 
 
 class Knight(Piece):
+    __slots__ = ()
     valore = 3
 
-    def __init__(self, color, position, board):
-        super().__init__(color, position, board)
-
     def move(self, start_pos, final_pos, board) -> int:
-        if start_pos == final_pos:
-            return 0
-        if (
-            (
-                (ord(final_pos[0]) == ord(start_pos[0]) + 2)
-                and (int(final_pos[1]) == int(start_pos[1]) + 1)
-            )
-            or (
-                (ord(final_pos[0]) == ord(start_pos[0]) + 1)
-                and (int(final_pos[1]) == int(start_pos[1]) + 2)
-            )
-            or (
-                (ord(final_pos[0]) == ord(start_pos[0]) - 1)
-                and (int(final_pos[1]) == int(start_pos[1]) - 2)
-            )
-            or (
-                (ord(final_pos[0]) == ord(start_pos[0]) - 2)
-                and (int(final_pos[1]) == int(start_pos[1]) - 1)
-            )
-            or (
-                (ord(final_pos[0]) == ord(start_pos[0]) - 1)
-                and (int(final_pos[1]) == int(start_pos[1]) + 2)
-            )
-            or (
-                (ord(final_pos[0]) == ord(start_pos[0]) - 2)
-                and (int(final_pos[1]) == int(start_pos[1]) + 1)
-            )
-            or (
-                (ord(final_pos[0]) == ord(start_pos[0]) + 1)
-                and (int(final_pos[1]) == int(start_pos[1]) - 2)
-            )
-            or (
-                (ord(final_pos[0]) == ord(start_pos[0]) + 2)
-                and (int(final_pos[1]) == int(start_pos[1]) - 1)
-            )
+        if KNIGHT_ATTACKS[start_pos] >> final_pos & 1 and (
+            board.squares[final_pos] == " "
+            or board.squares[final_pos].color != self.color
         ):
             return 1
         else:
             return 0
 
+    def generate_moves(self, board, square):
+        yield from self.step_moves(board, KNIGHT_TARGETS[square])
+
     def __str__(self) -> str:
         if self.color == "white":
             return "\u2658"
@@ -204,87 +573,27 @@ class Knight(Piece):
 
 
 class Bishop(Piece):
+    __slots__ = ()
     valore = 3
 
-    def __init__(self, color, position, board):
-        super().__init__(color, position, board)
-
     def move(self, start_pos, final_pos, board) -> int:
-        i = 1
-        if start_pos == final_pos:
+        cols = (final_pos & 7) - (start_pos & 7)
+        rows = (final_pos >> 3) - (start_pos >> 3)
+        if cols == 0 or abs(cols) != abs(rows):
             return 0
-        while i <= 9:
-            if i == 9:
+        if (
+            board.squares[final_pos] != " "
+            and board.squares[final_pos].color == self.color
+        ):
+            return 0
+        step = (8 if rows > 0 else -8) + (1 if cols > 0 else -1)
+        for square in range(start_pos + step, final_pos, step):
+            if board.squares[square] != " ":
                 return 0
-            if (
-                ord(start_pos[0]) == ord(final_pos[0]) - i
-                or ord(start_pos[0]) == ord(final_pos[0]) + i
-            ) and (
-                int(start_pos[1]) == int(final_pos[1]) + i
-                or int(start_pos[1]) == int(final_pos[1]) - i
-            ):
-                if self.color == "white":
-                    if (
-                        board.squares[final_pos] != " "
-                        and board.squares[final_pos].color == "white"
-                    ):
-                        return 0
-                else:
-                    if (
-                        board.squares[final_pos] != " "
-                        and board.squares[final_pos].color == "black"
-                    ):
-                        return 0
-                i -= 1
-                while i > 0:
-                    if (
-                        ord(final_pos[0]) > ord(start_pos[0])
-                        and final_pos[1] > start_pos[1]
-                    ):  # up/right
-                        if (
-                            board.squares[
-                                chr(ord(final_pos[0]) - i) + str(int(final_pos[1]) - i)
-                            ]
-                            != " "
-                        ):
-                            return 0
-                    elif (
-                        ord(final_pos[0]) > ord(start_pos[0])
-                        and final_pos[1] < start_pos[1]
-                    ):  # down/right
-                        if (
-                            board.squares[
-                                chr(ord(final_pos[0]) - i) + str(int(final_pos[1]) + i)
-                            ]
-                            != " "
-                        ):
-                            return 0
-                    elif (
-                        ord(final_pos[0]) < ord(start_pos[0])
-                        and final_pos[1] > start_pos[1]
-                    ):  # up/left
-                        if (
-                            board.squares[
-                                chr(ord(final_pos[0]) + i) + str(int(final_pos[1]) - i)
-                            ]
-                            != " "
-                        ):
-                            return 0
-                    elif (
-                        ord(final_pos[0]) < ord(start_pos[0])
-                        and final_pos[1] < start_pos[1]
-                    ):  # down/left
-                        if (
-                            board.squares[
-                                chr(ord(final_pos[0]) + i) + str(int(final_pos[1]) + i)
-                            ]
-                            != " "
-                        ):
-                            return 0
-                    i -= 1
-                return 1
-            i += 1
-        return 0
+        return 1
+
+    def generate_moves(self, board, square):
+        yield from self.ray_moves(board, BISHOP_RAYS[square])
 
     def __str__(self) -> str:
         if self.color == "white":
@@ -294,55 +603,30 @@ class Bishop(Piece):
 
 
 class Rook(Piece):
+    __slots__ = ()
     valore = 5
-    can_castle = 1
-
-    def __init__(self, color, position, board):
-        super().__init__(color, position, board)
 
     def move(self, start_pos, final_pos, board) -> int:
-        if start_pos[0] == final_pos[0] and start_pos != final_pos:
-            for x in range(
-                min(int(start_pos[1]), int(final_pos[1])) + 1,
-                max(int(start_pos[1]), int(final_pos[1])),
-            ):
-                if board.squares[start_pos[0] + str(x)] != " ":
-                    return 0
-            if (
-                self.color == "white"
-                and board.squares[final_pos] != " "
-                and board.squares[final_pos].color == "white"
-            ):
-                return 0
-            elif (
-                self.color == "black"
-                and board.squares[final_pos] != " "
-                and board.squares[final_pos].color == "black"
-            ):
-                return 0
-            return 1
-        elif start_pos[1] == final_pos[1] and start_pos != final_pos:
-            for x in range(
-                min(ord(start_pos[0]), ord(final_pos[0])) + 1,
-                max(ord(start_pos[0]), ord(final_pos[0])),
-            ):
-                if board.squares[chr(x) + start_pos[1]] != " ":
-                    return 0
-            if (
-                self.color == "white"
-                and board.squares[final_pos] != " "
-                and board.squares[final_pos].color == "white"
-            ):
-                return 0
-            elif (
-                self.color == "black"
-                and board.squares[final_pos] != " "
-                and board.squares[final_pos].color == "black"
-            ):
-                return 0
-            return 1
+        if start_pos == final_pos:
+            return 0
+        if (start_pos & 7) == (final_pos & 7):  # same column
+            step = 8 if final_pos > start_pos else -8
+        elif (start_pos >> 3) == (final_pos >> 3):  # same row
+            step = 1 if final_pos > start_pos else -1
         else:
             return 0
+        if (
+            board.squares[final_pos] != " "
+            and board.squares[final_pos].color == self.color
+        ):
+            return 0
+        for square in range(start_pos + step, final_pos, step):
+            if board.squares[square] != " ":
+                return 0
+        return 1
+
+    def generate_moves(self, board, square):
+        yield from self.ray_moves(board, ROOK_RAYS[square])
 
     def __str__(self) -> str:
         if self.color == "white":
@@ -352,132 +636,16 @@ class Rook(Piece):
 
 
 class Queen(Piece):
+    __slots__ = ()
     valore = 9
 
-    def __init__(self, color, position, board):
-        super().__init__(color, position, board)
-
     def move(self, start_pos, final_pos, board) -> int:
-        if start_pos == final_pos:
-            return 0
-        if start_pos[0] == final_pos[0]:
-            for x in range(
-                min(int(start_pos[1]), int(final_pos[1])) + 1,
-                max(int(start_pos[1]), int(final_pos[1])),
-            ):
-                if board.squares[start_pos[0] + str(x)] != " ":
-                    return 0
-            if (
-                self.color == "white"
-                and board.squares[final_pos] != " "
-                and board.squares[final_pos].color == "white"
-            ):
-                return 0
-            elif (
-                self.color == "black"
-                and board.squares[final_pos] != " "
-                and board.squares[final_pos].color == "black"
-            ):
-                return 0
+        if Rook.move(self, start_pos, final_pos, board):
             return 1
-        elif start_pos[1] == final_pos[1]:
-            for x in range(
-                min(ord(start_pos[0]), ord(final_pos[0])) + 1,
-                max(ord(start_pos[0]), ord(final_pos[0])),
-            ):
-                if board.squares[chr(x) + start_pos[1]] != " ":
-                    return 0
-            if (
-                self.color == "white"
-                and board.squares[final_pos] != " "
-                and board.squares[final_pos].color == "white"
-            ):
-                return 0
-            elif (
-                self.color == "black"
-                and board.squares[final_pos] != " "
-                and board.squares[final_pos].color == "black"
-            ):
-                return 0
-            return 1
-        else:
-            i = 1
-            while i <= 9:
-                if i == 9:
-                    return 0
-                if (
-                    ord(start_pos[0]) == ord(final_pos[0]) - i
-                    or ord(start_pos[0]) == ord(final_pos[0]) + i
-                ) and (
-                    int(start_pos[1]) == int(final_pos[1]) + i
-                    or int(start_pos[1]) == int(final_pos[1]) - i
-                ):
-                    if self.color == "white":
-                        if (
-                            board.squares[final_pos] != " "
-                            and board.squares[final_pos].color == "white"
-                        ):
-                            return 0
-                    else:
-                        if (
-                            board.squares[final_pos] != " "
-                            and board.squares[final_pos].color == "black"
-                        ):
-                            return 0
-                    i -= 1
-                    while i > 0:
-                        if (
-                            ord(final_pos[0]) > ord(start_pos[0])
-                            and final_pos[1] > start_pos[1]
-                        ):  # up/right
-                            if (
-                                board.squares[
-                                    chr(ord(final_pos[0]) - i)
-                                    + str(int(final_pos[1]) - i)
-                                ]
-                                != " "
-                            ):
-                                return 0
-                        elif (
-                            ord(final_pos[0]) > ord(start_pos[0])
-                            and final_pos[1] < start_pos[1]
-                        ):  # down/right
-                            if (
-                                board.squares[
-                                    chr(ord(final_pos[0]) - i)
-                                    + str(int(final_pos[1]) + i)
-                                ]
-                                != " "
-                            ):
-                                return 0
-                        elif (
-                            ord(final_pos[0]) < ord(start_pos[0])
-                            and final_pos[1] > start_pos[1]
-                        ):  # up/left
-                            if (
-                                board.squares[
-                                    chr(ord(final_pos[0]) + i)
-                                    + str(int(final_pos[1]) - i)
-                                ]
-                                != " "
-                            ):
-                                return 0
-                        elif (
-                            ord(final_pos[0]) < ord(start_pos[0])
-                            and final_pos[1] < start_pos[1]
-                        ):  # down/left
-                            if (
-                                board.squares[
-                                    chr(ord(final_pos[0]) + i)
-                                    + str(int(final_pos[1]) + i)
-                                ]
-                                != " "
-                            ):
-                                return 0
-                        i -= 1
-                    return 1
-                i += 1
-        return 0
+        return Bishop.move(self, start_pos, final_pos, board)
+
+    def generate_moves(self, board, square):
+        yield from self.ray_moves(board, RAYS[square])
 
     def __str__(self) -> str:
         if self.color == "white":
@@ -487,90 +655,56 @@ class Queen(Piece):
 
 
 class King(Piece):
+    __slots__ = ()
     valore = 1000
-    can_castle = 1
-
-    def __init__(self, color, position, board):
-        super().__init__(color, position, board)
 
     def move(self, start_pos, final_pos, board) -> int:
+        if self.color == "white":
+            first = 0  # a1
+        else:
+            first = 56  # a8
         if (
-            start_pos == "e1"
-            and final_pos == "g1"
-            and board.squares["f1"] == " "
-            and board.squares["g1"] == " "
-            and self.can_castle == 1
-            and isinstance(board.squares["h1"], Rook)
-            and board.squares["h1"].can_castle == 1
-            and board.check == False
-            and not is_attacked(True, "f1", board)
-            and not is_attacked(True, "g1", board)
-        ):
-            return 4
-        elif (
-            start_pos == "e1"
-            and final_pos == "c1"
-            and board.squares["b1"] == " "
-            and board.squares["c1"] == " "
-            and board.squares["d1"] == " "
-            and self.can_castle == 1
-            and isinstance(board.squares["a1"], Rook)
-            and board.squares["a1"].can_castle == 1
-            and board.check == False
-            and not is_attacked(True, "c1", board)
-            and not is_attacked(True, "d1", board)
-        ):
-            return 5
-        elif (
-            start_pos == "e8"
-            and final_pos == "g8"
-            and board.squares["f8"] == " "
-            and board.squares["g8"] == " "
-            and self.can_castle == 1
-            and isinstance(board.squares["h8"], Rook)
-            and board.squares["h8"].can_castle == 1
-            and board.check == False
-            and not is_attacked(False, "f8", board)
-            and not is_attacked(False, "g8", board)
+            start_pos == first + 4
+            and final_pos == first + 6
+            and board.squares[first + 5] == " "
+            and board.squares[first + 6] == " "
+            and board.castling & (1 if self.color == "white" else 4)
+            and isinstance(board.squares[first + 7], Rook)
+            and not is_attacked(self.color == "white", first + 4, board)
+            and not is_attacked(self.color == "white", first + 5, board)
+            and not is_attacked(self.color == "white", first + 6, board)
         ):
             return 4
         elif (
-            start_pos == "e8"
-            and final_pos == "c8"
-            and board.squares["b8"] == " "
-            and board.squares["c8"] == " "
-            and board.squares["d8"] == " "
-            and self.can_castle == 1
-            and isinstance(board.squares["a8"], Rook)
-            and board.squares["a8"].can_castle == 1
-            and board.check == False
-            and not is_attacked(False, "c8", board)
-            and not is_attacked(False, "d8", board)
+            start_pos == first + 4
+            and final_pos == first + 2
+            and board.squares[first + 1] == " "
+            and board.squares[first + 2] == " "
+            and board.squares[first + 3] == " "
+            and board.castling & (2 if self.color == "white" else 8)
+            and isinstance(board.squares[first], Rook)
+            and not is_attacked(self.color == "white", first + 4, board)
+            and not is_attacked(self.color == "white", first + 2, board)
+            and not is_attacked(self.color == "white", first + 3, board)
         ):
             return 5
-        if (
-            (
-                ord(final_pos[0]) in range(ord(start_pos[0]) - 1, ord(start_pos[0]) + 2)
-            )  # use +2 because range excludes the final number
-            and int(final_pos[1]) in range(int(start_pos[1]) - 1, int(start_pos[1]) + 2)
-            and start_pos != final_pos
-        ):
-            if self.color == "white":
-                if (
-                    board.squares[final_pos] != " "
-                    and board.squares[final_pos].color == "white"
-                ):
-                    return 0
-            else:
-                if (
-                    board.squares[final_pos] != " "
-                    and board.squares[final_pos].color == "black"
-                ):
-                    return 0
+        if KING_ATTACKS[start_pos] >> final_pos & 1:
+            if (
+                board.squares[final_pos] != " "
+                and board.squares[final_pos].color == self.color
+            ):
+                return 0
             return 1
         else:
             return 0
 
+    def generate_moves(self, board, square):
+        yield from self.step_moves(board, KING_TARGETS[square])
+        if board.castling & (3 if self.color == "white" else 12) and square in (4, 60):
+            for target in (square + 2, square - 2):
+                if self.move(square, target, board):
+                    yield target
+
     def __str__(self) -> str:
         if self.color == "white":
             return "\u2654"
@@ -578,28 +712,1195 @@ class King(Piece):
             return "\u265a"
 
 
-def main():
-    game = Chessboard()
-    pieces = start_game(game)  # Initialize all pieces
-    for piece in pieces:  # Put pieces on the chessboard
-        game.squares[piece.position] = piece
-        # if isinstance(piece, King):
-        #    if piece.color == "white":
-        #        wking = piece
-        #    else:
-        #        bking = piece
-    white_turn = True
-    en_passant_count = 0
-    turn = 0
+# Zobrist keys: one random number per piece and square, castling rights,
+# en passant file and side to move, drawn from a fixed seed
+zobrist_random = random.Random(20240101)
+ZOBRIST_PIECES = {
+    color: {
+        kind: [zobrist_random.getrandbits(64) for square in range(64)]
+        for kind in (Pawn, Knight, Bishop, Rook, Queen, King)
+    }
+    for color in ("white", "black")
+}
+ZOBRIST_CASTLING = [0] + [zobrist_random.getrandbits(64) for rights in range(1, 16)]
+ZOBRIST_EP = [zobrist_random.getrandbits(64) for col in range(8)]
+ZOBRIST_BLACK_TO_MOVE = zobrist_random.getrandbits(64)
+
+PROMOTIONS = {Queen: "q", Rook: "r", Bishop: "b", Knight: "n"}
+PIECE_LETTERS = {Pawn: "", Knight: "N", Bishop: "B", Rook: "R", Queen: "Q", King: "K"}
+PROMOTION_CODES = [None, Knight, Bishop, Rook, Queen]
+
+
+class PGNWriter:
+
+    def __init__(self, path: str, headers: dict = None, flush_every: int = 0):
+        self.path = path
+        self.headers = {  # the seven tag roster, in the order PGN requires
+            "Event": "Casual game",
+            "Site": "chess_sim V1.0",
+            "Date": time.strftime("%Y.%m.%d"),
+            "Round": "-",
+            "White": "White",
+            "Black": "Black",
+            "Result": "*",
+        }
+        if headers != None:
+            self.headers.update(headers)
+        self.moves = []  # [SAN, check or mate suffix] for every ply
+        self.first_ply = 0  # plies played before the starting position
+        self.flush_every = flush_every
+        self.written = 0  # plies already appended to the file
+        self.column = 0  # length of the last line in the file
+
+    def set_position(self, board: Chessboard) -> None:
+        # A game that does not start from the initial position
+        self.headers["SetUp"] = "1"
+        self.headers["FEN"] = board.to_fen()
+        self.first_ply = 2 * (board.fullmove_number - 1) + (board.white_turn == False)
+
+    def add_move(self, san: str) -> None:
+        # The moves before this one can no longer get a check suffix, so they
+        # are the ones appended to the file
+        if self.flush_every > 0 and len(self.moves) - self.written >= self.flush_every:
+            self.append_moves()
+        self.moves.append([san, ""])
+
+    def take_back(self) -> None:
+        self.moves.pop()
+        self.set_result("*")
+        if len(self.moves) < self.written:  # the file is written from scratch
+            self.written = 0
+
+    def mark_check(self) -> None:
+        self.moves[-1][1] = "+"
+
+    def mark_checkmate(self) -> None:
+        self.moves[-1][1] = "#"
+
+    def set_result(self, result: str) -> None:
+        self.headers["Result"] = result
+
+    def tokens(self, first: int = 0, last: int = None):
+        for ply in range(first, len(self.moves) if last == None else last):
+            san, suffix = self.moves[ply]
+            number = (self.first_ply + ply) // 2 + 1
+            if (self.first_ply + ply) % 2 == 0:
+                yield f"{number}. {san}{suffix}"
+            elif ply == 0:  # a game that starts with black to move
+                yield f"{number}... {san}{suffix}"
+            else:
+                yield san + suffix
+
+    @staticmethod
+    def wrap(tokens, column: int = 0) -> tuple:
+        # Joins the tokens in lines of at most 79 characters, going on from a
+        # line that already holds column characters
+        text = ""
+        for token in tokens:
+            if column == 0:
+                text += token
+                column = len(token)
+            elif column + len(token) + 1 > 79:
+                text += "\n" + token
+                column = len(token)
+            else:
+                text += " " + token
+                column += len(token) + 1
+        return text, column
 
-    with open("chess_sim_PGN.txt", "w", encoding="utf-8") as pgn:
-        pgn.write("Created with chess_sim V1.0\n\n")
+    def movetext(self) -> str:
+        return self.wrap([*self.tokens(), self.headers["Result"]])[0]
 
+    def tags(self) -> str:
+        return "".join(f'[{name} "{value}"]\n' for name, value in self.headers.items())
+
+    def __str__(self) -> str:
+        return f"{self.tags()}\n{self.movetext()}\n"
+
+    def append_moves(self) -> None:
+        # Adds the moves since the last write to the file, without the result
+        if self.path == None:
+            return
+        last = len(self.moves)
+        if self.written == 0:
+            with open(self.path, "w", encoding="utf-8") as pgn:
+                pgn.write(self.tags() + "\n")
+            self.column = 0
+        text, self.column = self.wrap(self.tokens(self.written, last), self.column)
+        with open(self.path, "a", encoding="utf-8") as pgn:
+            pgn.write(text)
+        self.written = last
+
+    def flush(self) -> None:
+        # Writes the whole game with its result, once it is over
+        if self.path == None:  # kept in memory only
+            return
+        with open(self.path, "w", encoding="utf-8") as pgn:
+            pgn.write(str(self))
+
+
+BOUND_EXACT, BOUND_LOWER, BOUND_UPPER = 0, 1, 2
+STATUS_UNKNOWN, STATUS_PLAYING, STATUS_CHECK, STATUS_CHECKMATE, STATUS_STALEMATE = (
+    range(5)
+)
+SCORE_OFFSET = 1 << 23  # scores are stored in 24 bits
+
+
+class TranspositionTable:
+    entry_size = 16  # bytes per entry: 64-bit key and 64-bit packed data
+
+    def __init__(self, size_mb: int = 16):
+        # Each bucket holds a depth-preferred entry and an always-replace entry
+        buckets = max(1, size_mb * 1024 * 1024 // (2 * self.entry_size))
+        buckets = 1 << (buckets.bit_length() - 1)  # a power of two, indexed by mask
+        self.mask = buckets - 1
+        self.keys = array("Q", bytes(2 * 8 * buckets))
+        self.data = array("Q", bytes(2 * 8 * buckets))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def clear(self) -> None:
+        self.keys = array("Q", bytes(8 * len(self.keys)))
+        self.data = array("Q", bytes(8 * len(self.data)))
+
+    def probe(self, key: int):
+        index = (key & self.mask) * 2
+        for slot in (index, index + 1):
+            if self.keys[slot] == key and self.data[slot] != 0:
+                return self.unpack(self.data[slot])
+        return None
+
+    def store(
+        self,
+        key: int,
+        depth: int,
+        score: int,
+        bound: int = BOUND_EXACT,
+        move=None,
+        status: int = STATUS_UNKNOWN,
+    ) -> None:
+        index = (key & self.mask) * 2
+        if self.keys[index] == key or self.data[index] == 0:
+            slot = index
+        elif self.keys[index + 1] == key:
+            slot = index + 1
+        elif depth >= self.data[index] >> 24 & 0xFF:
+            slot = index  # deeper results take the depth-preferred entry
+        else:
+            slot = index + 1
+        if status == STATUS_UNKNOWN and self.keys[slot] == key:
+            status = self.data[slot] >> 34 & 0x7  # keep a known game status
+        if move == None and self.keys[slot] == key:
+            move = self.unpack(self.data[slot])[3]
+
+        if slot == index and self.keys[slot] != key and self.data[slot] != 0:
+            # the depth-preferred entry is replaced, demote it to the other slot
+            self.keys[index + 1] = self.keys[index]
+            self.data[index + 1] = self.data[index]
+        self.keys[slot] = key
+        self.data[slot] = self.pack(depth, score, bound, move, status)
+
+    def store_status(self, key: int, status: int) -> None:
+        entry = self.probe(key)
+        if entry != None:
+            self.store(key, entry[0], entry[1], entry[2], entry[3], status)
+        else:
+            self.store(key, 0, 0, BOUND_UPPER, None, status)
+
+    def pack(self, depth: int, score: int, bound: int, move, status: int) -> int:
+        data = max(1, min(score + SCORE_OFFSET, (1 << 24) - 1))
+        data |= min(depth, 255) << 24 | bound << 32 | status << 34
+        if move != None:
+            move_from, move_to, promotion = move
+            code = 0
+            if promotion != None:
+                code = PROMOTION_CODES.index(
+                    promotion if isinstance(promotion, type) else type(promotion)
+                )
+            data |= (move_from | move_to << 6 | code << 12) << 40
+        return data
+
+    def unpack(self, data: int):
+        move = None
+        if data >> 40:
+            move = (
+                data >> 40 & 63,
+                data >> 46 & 63,
+                PROMOTION_CODES[data >> 52 & 7],
+            )
+        return (
+            data >> 24 & 0xFF,  # depth
+            (data & 0xFFFFFF) - SCORE_OFFSET,  # score
+            data >> 32 & 0x3,  # bound
+            move,
+            data >> 34 & 0x7,  # game status
+        )
+
+
+FEN_PIECES = {"p": Pawn, "n": Knight, "b": Bishop, "r": Rook, "q": Queen, "k": King}
+FEN_LETTERS = {kind: letter for letter, kind in FEN_PIECES.items()}
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+PERFT_POSITIONS = [  # name, FEN, expected leaf nodes for depth 1, 2, ...
+    ("start", START_FEN, [20, 400, 8902, 197281, 4865609, 119060324]),
+    (
+        "kiwipete",
+        "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        [48, 2039, 97862, 4085603, 193690690],
+    ),
+    (
+        "position 3",
+        "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+        [14, 191, 2812, 43238, 674624, 11030083],
+    ),
+    (
+        "position 4",
+        "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+        [6, 264, 9467, 422333, 15833292],
+    ),
+    (
+        "position 5",
+        "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+        [44, 1486, 62379, 2103487, 89941194],
+    ),
+]
+
+
+# Piece-square tables in centipawns, seen from white with rank 8 on top
+PIECE_SQUARE_ROWS = {
+    Pawn: [
+        [0, 0, 0, 0, 0, 0, 0, 0],
+        [50, 50, 50, 50, 50, 50, 50, 50],
+        [10, 10, 20, 30, 30, 20, 10, 10],
+        [5, 5, 10, 25, 25, 10, 5, 5],
+        [0, 0, 0, 20, 20, 0, 0, 0],
+        [5, -5, -10, 0, 0, -10, -5, 5],
+        [5, 10, 10, -20, -20, 10, 10, 5],
+        [0, 0, 0, 0, 0, 0, 0, 0],
+    ],
+    Knight: [
+        [-50, -40, -30, -30, -30, -30, -40, -50],
+        [-40, -20, 0, 0, 0, 0, -20, -40],
+        [-30, 0, 10, 15, 15, 10, 0, -30],
+        [-30, 5, 15, 20, 20, 15, 5, -30],
+        [-30, 0, 15, 20, 20, 15, 0, -30],
+        [-30, 5, 10, 15, 15, 10, 5, -30],
+        [-40, -20, 0, 5, 5, 0, -20, -40],
+        [-50, -40, -30, -30, -30, -30, -40, -50],
+    ],
+    Bishop: [
+        [-20, -10, -10, -10, -10, -10, -10, -20],
+        [-10, 0, 0, 0, 0, 0, 0, -10],
+        [-10, 0, 5, 10, 10, 5, 0, -10],
+        [-10, 5, 5, 10, 10, 5, 5, -10],
+        [-10, 0, 10, 10, 10, 10, 0, -10],
+        [-10, 10, 10, 10, 10, 10, 10, -10],
+        [-10, 5, 0, 0, 0, 0, 5, -10],
+        [-20, -10, -10, -10, -10, -10, -10, -20],
+    ],
+    Rook: [
+        [0, 0, 0, 0, 0, 0, 0, 0],
+        [5, 10, 10, 10, 10, 10, 10, 5],
+        [-5, 0, 0, 0, 0, 0, 0, -5],
+        [-5, 0, 0, 0, 0, 0, 0, -5],
+        [-5, 0, 0, 0, 0, 0, 0, -5],
+        [-5, 0, 0, 0, 0, 0, 0, -5],
+        [-5, 0, 0, 0, 0, 0, 0, -5],
+        [0, 0, 0, 5, 5, 0, 0, 0],
+    ],
+    Queen: [
+        [-20, -10, -10, -5, -5, -10, -10, -20],
+        [-10, 0, 0, 0, 0, 0, 0, -10],
+        [-10, 0, 5, 5, 5, 5, 0, -10],
+        [-5, 0, 5, 5, 5, 5, 0, -5],
+        [0, 0, 5, 5, 5, 5, 0, -5],
+        [-10, 5, 5, 5, 5, 5, 0, -10],
+        [-10, 0, 5, 0, 0, 0, 0, -10],
+        [-20, -10, -10, -5, -5, -10, -10, -20],
+    ],
+    King: [
+        [-30, -40, -40, -50, -50, -40, -40, -30],
+        [-30, -40, -40, -50, -50, -40, -40, -30],
+        [-30, -40, -40, -50, -50, -40, -40, -30],
+        [-30, -40, -40, -50, -50, -40, -40, -30],
+        [-20, -30, -30, -40, -40, -30, -30, -20],
+        [-10, -20, -20, -20, -20, -20, -20, -10],
+        [20, 20, 0, 0, 0, 0, 20, 20],
+        [20, 30, 10, 0, 0, 10, 30, 20],
+    ],
+}
+# valore in centipawns plus the table, indexed by colour, piece class and square
+PIECE_SQUARE = {
+    "white": {
+        kind: [kind.valore * 100 + rows[7 - (sq >> 3)][sq & 7] for sq in range(64)]
+        for kind, rows in PIECE_SQUARE_ROWS.items()
+    },
+    "black": {
+        kind: [kind.valore * 100 + rows[sq >> 3][sq & 7] for sq in range(64)]
+        for kind, rows in PIECE_SQUARE_ROWS.items()
+    },
+}
+MATE_SCORE = 100000
+MATE_BOUND = MATE_SCORE - 1000  # scores beyond this are mates, counted in plies
+MAX_DEPTH = 64
+CHECK_EVERY = 256  # nodes between two looks at the clock
+
+
+class SearchAborted(Exception):
+    pass
+
+
+def move_budget(clock: int, increment: int = 0) -> int:
+    # Milliseconds to spend on a move with clock ms left and increment ms a move
+    budget = clock // 30 + increment * 3 // 4
+    return max(1, min(budget, clock - 50))
+
+
+class Engine:
+
+    def __init__(self, table: TranspositionTable = None):
+        self.table = table if table != None else TranspositionTable()
+        self.nodes = 0
+        self.deadline = None
+        self.max_nodes = None
+        self.next_check = CHECK_EVERY
+
+    def evaluate(self, board: Chessboard) -> int:
+        score = board.score["white"] - board.score["black"]
+        return score if board.white_turn == True else -score
+
+    def ordered_moves(self, board: Chessboard, best=None, captures_only=False):
+        # The move from the table first, then captures by MVV-LVA, then the rest
+        scored = []
+        for move in pseudo_legal_moves(board):
+            move_from, move_to, promotion = move
+            piece, victim = board.squares[move_from], board.squares[move_to]
+            if victim != " ":
+                order = victim.valore * 1024 - piece.valore
+            elif isinstance(piece, Pawn) and (move_from & 7) != (move_to & 7):
+                order = Pawn.valore * 1024 - Pawn.valore  # en passant
+            elif promotion == None and captures_only == True:
+                continue
+            else:
+                order = 0
+            if promotion != None:
+                order += promotion.valore * 1024
+            if (
+                best != None
+                and best[0] == move_from
+                and best[1] == move_to
+                and best[2] == (None if promotion == None else type(promotion))
+            ):
+                order = 1 << 30
+            scored.append((order, move))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [move for order, move in scored]
+
+    def check_limits(self) -> None:
+        self.next_check = self.nodes + CHECK_EVERY
+        if self.deadline != None and time.perf_counter() > self.deadline:
+            raise SearchAborted()
+        if self.max_nodes != None and self.nodes >= self.max_nodes:
+            raise SearchAborted()
+
+    def quiesce(self, board: Chessboard, alpha: int, beta: int) -> int:
+        self.nodes += 1
+        if self.nodes >= self.next_check:
+            self.check_limits()
+        score = self.evaluate(board)
+        if score >= beta:
+            return score
+        alpha = max(alpha, score)
+        color = "white" if board.white_turn == True else "black"
+        for move in self.ordered_moves(board, captures_only=True):
+            board.make_move(*move)
+            if is_attacked(color == "white", board.king_square[color], board):
+                board.unmake_move()
+                continue
+            score = -self.quiesce(board, -beta, -alpha)
+            board.unmake_move()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    def negamax(
+        self, board: Chessboard, depth: int, alpha: int, beta: int, ply: int = 0
+    ) -> int:
+        if depth <= 0:
+            return self.quiesce(board, alpha, beta)
+        self.nodes += 1
+        if self.nodes >= self.next_check:
+            self.check_limits()
+        best = None
+        entry = self.table.probe(board.key)
+        if entry != None:
+            if entry[4] == STATUS_CHECKMATE:
+                return -MATE_SCORE + ply
+            if entry[4] == STATUS_STALEMATE:
+                return 0
+            best = entry[3]
+            if entry[0] >= depth and ply > 0:
+                score = entry[1]  # mates are stored relative to this position
+                if score > MATE_BOUND:
+                    score -= ply
+                elif score < -MATE_BOUND:
+                    score += ply
+                if entry[2] == BOUND_EXACT:
+                    return score
+                if entry[2] == BOUND_LOWER and score >= beta:
+                    return score
+                if entry[2] == BOUND_UPPER and score <= alpha:
+                    return score
+
+        color = "white" if board.white_turn == True else "black"
+        start_alpha = alpha
+        best_score, best_move = -MATE_SCORE - 1, None
+        for move in self.ordered_moves(board, best):
+            board.make_move(*move)
+            if is_attacked(color == "white", board.king_square[color], board):
+                board.unmake_move()
+                continue
+            score = -self.negamax(board, depth - 1, -beta, -alpha, ply + 1)
+            board.unmake_move()
+            if score > best_score:
+                best_score, best_move = score, move
+                if ply == 0:
+                    self.best_move = move
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+
+        if best_move == None:  # no legal move
+            if is_attacked(board.white_turn, board.king_square[color], board):
+                self.table.store_status(board.key, STATUS_CHECKMATE)
+                return -MATE_SCORE + ply
+            self.table.store_status(board.key, STATUS_STALEMATE)
+            return 0
+        if best_score <= start_alpha:
+            bound = BOUND_UPPER
+        elif best_score >= beta:
+            bound = BOUND_LOWER
+        else:
+            bound = BOUND_EXACT
+        score = best_score
+        if score > MATE_BOUND:
+            score += ply
+        elif score < -MATE_BOUND:
+            score -= ply
+        self.table.store(board.key, depth, score, bound, best_move)
+        return best_score
+
+    def search(
+        self,
+        board: Chessboard,
+        depth: int = MAX_DEPTH,
+        movetime: int = None,
+        max_nodes: int = None,
+        report=None,
+    ) -> tuple:
+        # Iterative deepening: searches depth 1, 2, ... until depth, movetime ms
+        # or max_nodes run out, and returns the best move of the last completed
+        # depth as (from, to, promotion class) with its score
+        start = time.perf_counter()
+        self.nodes = 0
+        self.next_check = CHECK_EVERY
+        self.deadline = None if movetime == None else start + movetime / 1000
+        self.max_nodes = max_nodes
+        history = len(board.history)
+        best_move, best_score = None, 0
+        for current in range(1, depth + 1):
+            self.best_move = None
+            try:
+                score = self.negamax(board, current, -MATE_SCORE - 1, MATE_SCORE + 1)
+            except SearchAborted:
+                while len(board.history) > history:  # undo the unfinished line
+                    board.unmake_move()
+                if best_move == None:  # not even depth 1 finished
+                    move = self.best_move or (list(legal_moves(board)) or [None])[0]
+                    if move != None:
+                        best_move = (
+                            move[0],
+                            move[1],
+                            None if move[2] == None else type(move[2]),
+                        )
+                break
+            if self.best_move == None:  # checkmate or stalemate on the board
+                return None, score
+            move_from, move_to, promotion = self.best_move
+            best_move = (
+                move_from,
+                move_to,
+                None if promotion == None else type(promotion),
+            )
+            best_score = score
+            elapsed = time.perf_counter() - start
+            if report != None:
+                report(
+                    f"depth {current:>2}  score {score:>6}  nodes {self.nodes:>9}  "
+                    f"{int(self.nodes / max(elapsed, 1e-6)):>7} nps  "
+                    f"{int(elapsed * 1000):>6} ms  "
+                    f"pv {' '.join(self.principal_variation(board, current))}"
+                )
+            if abs(score) > MATE_BOUND:
+                break
+            if movetime != None and elapsed * 2000 > movetime:
+                break  # the next depth would not finish in time
+        return best_move, best_score
+
+    def principal_variation(self, board: Chessboard, depth: int) -> list:
+        # Follows the best moves kept in the transposition table
+        line = []
+        for ply in range(depth):
+            entry = self.table.probe(board.key)
+            if entry == None or entry[3] == None:
+                break
+            for move in list(legal_moves(board)):
+                if (move[0], move[1]) == entry[3][:2] and entry[3][2] == (
+                    None if move[2] == None else type(move[2])
+                ):
+                    line.append(move)
+                    board.make_move(*move)
+                    break
+            else:
+                break
+        for move in line:
+            board.unmake_move()
+        return [move_name(*move) for move in line]
+
+
+class MoveCache:
+    # Least recently used map from position key to (legal moves, game status)
+
+    def __init__(self, size: int = 4096):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: int):
+        entry = self.entries.get(key)
+        if entry == None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: int, moves: list, status: int) -> None:
+        self.entries[key] = (moves, status)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "entries": len(self.entries),
+        }
+
+
+# The Random64 table of the Polyglot book format: 768 piece keys (12 kinds of
+# 64 squares), 4 castling rights, 8 en passant files and white to move
+POLYGLOT_RANDOM = [int(word, 16) for word in """
+9D39247E33776D41 2AF7398005AAA5C7 44DB015024623547 9C15F73E62A76AE2
+75834465489C0C89 3290AC3A203001BF 0FBBAD1F61042279 E83A908FF2FB60CA
+0D7E765D58755C10 1A083822CEAFE02D 9605D5F0E25EC3B0 D021FF5CD13A2ED5
+40BDF15D4A672E32 011355146FD56395 5DB4832046F3D9E5 239F8B2D7FF719CC
+05D1A1AE85B49AA1 679F848F6E8FC971 7449BBFF801FED0B 7D11CDB1C3B7ADF0
+82C7709E781EB7CC F3218F1C9510786C 331478F3AF51BBE6 4BB38DE5E7219443
+AA649C6EBCFD50FC 8DBD98A352AFD40B 87D2074B81D79217 19F3C751D3E92AE1
+B4AB30F062B19ABF 7B0500AC42047AC4 C9452CA81A09D85D 24AA6C514DA27500
+4C9F34427501B447 14A68FD73C910841 A71B9B83461CBD93 03488B95B0F1850F
+637B2B34FF93C040 09D1BC9A3DD90A94 3575668334A1DD3B 735E2B97A4C45A23
+18727070F1BD400B 1FCBACD259BF02E7 D310A7C2CE9B6555 BF983FE0FE5D8244
+9F74D14F7454A824 51EBDC4AB9BA3035 5C82C505DB9AB0FA FCF7FE8A3430B241
+3253A729B9BA3DDE 8C74C368081B3075 B9BC6C87167C33E7 7EF48F2B83024E20
+11D505D4C351BD7F 6568FCA92C76A243 4DE0B0F40F32A7B8 96D693460CC37E5D
+42E240CB63689F2F 6D2BDCDAE2919661 42880B0236E4D951 5F0F4A5898171BB6
+39F890F579F92F88 93C5B5F47356388B 63DC359D8D231B78 EC16CA8AEA98AD76
+5355F900C2A82DC7 07FB9F855A997142 5093417AA8A7ED5E 7BCBC38DA25A7F3C
+19FC8A768CF4B6D4 637A7780DECFC0D9 8249A47AEE0E41F7 79AD695501E7D1E8
+14ACBAF4777D5776 F145B6BECCDEA195 DABF2AC8201752FC 24C3C94DF9C8D3F6
+BB6E2924F03912EA 0CE26C0B95C980D9 A49CD132BFBF7CC4 E99D662AF4243939
+27E6AD7891165C3F 8535F040B9744FF1 54B3F4FA5F40D873 72B12C32127FED2B
+EE954D3C7B411F47 9A85AC909A24EAA1 70AC4CD9F04F21F5 F9B89D3E99A075C2
+87B3E2B2B5C907B1 A366E5B8C54F48B8 AE4A9346CC3F7CF2 1920C04D47267BBD
+87BF02C6B49E2AE9 092237AC237F3859 FF07F64EF8ED14D0 8DE8DCA9F03CC54E
+9C1633264DB49C89 B3F22C3D0B0B38ED 390E5FB44D01144B 5BFEA5B4712768E9
+1E1032911FA78984 9A74ACB964E78CB3 4F80F7A035DAFB04 6304D09A0B3738C4
+2171E64683023A08 5B9B63EB9CEFF80C 506AACF489889342 1881AFC9A3A701D6
+6503080440750644 DFD395339CDBF4A7 EF927DBCF00C20F2 7B32F7D1E03680EC
+B9FD7620E7316243 05A7E8A57DB91B77 B5889C6E15630A75 4A750A09CE9573F7
+CF464CEC899A2F8A F538639CE705B824 3C79A0FF5580EF7F EDE6C87F8477609D
+799E81F05BC93F31 86536B8CF3428A8C 97D7374C60087B73 A246637CFF328532
+043FCAE60CC0EBA0 920E449535DD359E 70EB093B15B290CC 73A1921916591CBD
+56436C9FE1A1AA8D EFAC4B70633B8F81 BB215798D45DF7AF 45F20042F24F1768
+930F80F4E8EB7462 FF6712FFCFD75EA1 AE623FD67468AA70 DD2C5BC84BC8D8FC
+7EED120D54CF2DD9 22FE545401165F1C C91800E98FB99929 808BD68E6AC10365
+DEC468145B7605F6 1BEDE3A3AEF53302 43539603D6C55602 AA969B5C691CCB7A
+A87832D392EFEE56 65942C7B3C7E11AE DED2D633CAD004F6 21F08570F420E565
+B415938D7DA94E3C 91B859E59ECB6350 10CFF333E0ED804A 28AED140BE0BB7DD
+C5CC1D89724FA456 5648F680F11A2741 2D255069F0B7DAB3 9BC5A38EF729ABD4
+EF2F054308F6A2BC AF2042F5CC5C2858 480412BAB7F5BE2A AEF3AF4A563DFE43
+19AFE59AE451497F 52593803DFF1E840 F4F076E65F2CE6F0 11379625747D5AF3
+BCE5D2248682C115 9DA4243DE836994F 066F70B33FE09017 4DC4DE189B671A1C
+51039AB7712457C3 C07A3F80C31FB4B4 B46EE9C5E64A6E7C B3819A42ABE61C87
+21A007933A522A20 2DF16F761598AA4F 763C4A1371B368FD F793C46702E086A0
+D7288E012AEB8D31 DE336A2A4BC1C44B 0BF692B38D079F23 2C604A7A177326B3
+4850E73E03EB6064 CFC447F1E53C8E1B B05CA3F564268D99 9AE182C8BC9474E8
+A4FC4BD4FC5558CA E755178D58FC4E76 69B97DB1A4C03DFE F9B5B7C4ACC67C96
+FC6A82D64B8655FB 9C684CB6C4D24417 8EC97D2917456ED0 6703DF9D2924E97E
+C547F57E42A7444E 78E37644E7CAD29E FE9A44E9362F05FA 08BD35CC38336615
+9315E5EB3A129ACE 94061B871E04DF75 DF1D9F9D784BA010 3BBA57B68871B59D
+D2B7ADEEDED1F73F F7A255D83BC373F8 D7F4F2448C0CEB81 D95BE88CD210FFA7
+336F52F8FF4728E7 A74049DAC312AC71 A2F61BB6E437FDB5 4F2A5CB07F6A35B3
+87D380BDA5BF7859 16B9F7E06C453A21 7BA2484C8A0FD54E F3A678CAD9A2E38C
+39B0BF7DDE437BA2 FCAF55C1BF8A4424 18FCF680573FA594 4C0563B89F495AC3
+40E087931A00930D 8CFFA9412EB642C1 68CA39053261169F 7A1EE967D27579E2
+9D1D60E5076F5B6F 3810E399B6F65BA2 32095B6D4AB5F9B1 35CAB62109DD038A
+A90B24499FCFAFB1 77A225A07CC2C6BD 513E5E634C70E331 4361C0CA3F692F12
+D941ACA44B20A45B 528F7C8602C5807B 52AB92BEB9613989 9D1DFA2EFC557F73
+722FF175F572C348 1D1260A51107FE97 7A249A57EC0C9BA2 04208FE9E8F7F2D6
+5A110C6058B920A0 0CD9A497658A5698 56FD23C8F9715A4C 284C847B9D887AAE
+04FEABFBBDB619CB 742E1E651C60BA83 9A9632E65904AD3C 881B82A13B51B9E2
+506E6744CD974924 B0183DB56FFC6A79 0ED9B915C66ED37E 5E11E86D5873D484
+F678647E3519AC6E 1B85D488D0F20CC5 DAB9FE6525D89021 0D151D86ADB73615
+A865A54EDCC0F019 93C42566AEF98FFB 99E7AFEABE000731 48CBFF086DDF285A
+7F9B6AF1EBF78BAF 58627E1A149BBA21 2CD16E2ABD791E33 D363EFF5F0977996
+0CE2A38C344A6EED 1A804AADB9CFA741 907F30421D78C5DE 501F65EDB3034D07
+37624AE5A48FA6E9 957BAF61700CFF4E 3A6C27934E31188A D49503536ABCA345
+088E049589C432E0 F943AEE7FEBF21B8 6C3B8E3E336139D3 364F6FFA464EE52E
+D60F6DCEDC314222 56963B0DCA418FC0 16F50EDF91E513AF EF1955914B609F93
+565601C0364E3228 ECB53939887E8175 BAC7A9A18531294B B344C470397BBA52
+65D34954DAF3CEBD B4B81B3FA97511E2 B422061193D6F6A7 071582401C38434D
+7A13F18BBEDC4FF5 BC4097B116C524D2 59B97885E2F2EA28 99170A5DC3115544
+6F423357E7C6A9F9 325928EE6E6F8794 D0E4366228B03343 565C31F7DE89EA27
+30F5611484119414 D873DB391292ED4F 7BD94E1D8E17DEBC C7D9F16864A76E94
+947AE053EE56E63C C8C93882F9475F5F 3A9BF55BA91F81CA D9A11FBB3D9808E4
+0FD22063EDC29FCA B3F256D8ACA0B0B9 B03031A8B4516E84 35DD37D5871448AF
+E9F6082B05542E4E EBFAFA33D7254B59 9255ABB50D532280 B9AB4CE57F2D34F3
+693501D628297551 C62C58F97DD949BF CD454F8F19C5126A BBE83F4ECC2BDECB
+DC842B7E2819E230 BA89142E007503B8 A3BC941D0A5061CB E9F6760E32CD8021
+09C7E552BC76492F 852F54934DA55CC9 8107FCCF064FCF56 098954D51FFF6580
+23B70EDB1955C4BF C330DE426430F69D 4715ED43E8A45C0A A8D7E4DAB780A08D
+0572B974F03CE0BB B57D2E985E1419C7 E8D9ECBE2CF3D73F 2FE4B17170E59750
+11317BA87905E790 7FBF21EC8A1F45EC 1725CABFCB045B00 964E915CD5E2B207
+3E2B8BCBF016D66D BE7444E39328A0AC F85B2B4FBCDE44B7 49353FEA39BA63B1
+1DD01AAFCD53486A 1FCA8A92FD719F85 FC7C95D827357AFA 18A6A990C8B35EBD
+CCCB7005C6B9C28D 3BDBB92C43B17F26 AA70B5B4F89695A2 E94C39A54A98307F
+B7A0B174CFF6F36E D4DBA84729AF48AD 2E18BC1AD9704A68 2DE0966DAF2F8B1C
+B9C11D5B1E43A07E 64972D68DEE33360 94628D38D0C20584 DBC0D2B6AB90A559
+D2733C4335C6A72F 7E75D99D94A70F4D 6CED1983376FA72B 97FCAACBF030BC24
+7B77497B32503B12 8547EDDFB81CCB94 79999CDFF70902CB CFFE1939438E9B24
+829626E3892D95D7 92FAE24291F2B3F1 63E22C147B9C3403 C678B6D860284A1C
+5873888850659AE7 0981DCD296A8736D 9F65789A6509A440 9FF38FED72E9052F
+E479EE5B9930578C E7F28ECD2D49EECD 56C074A581EA17FE 5544F7D774B14AEF
+7B3F0195FC6F290F 12153635B2C0CF57 7F5126DBBA5E0CA7 7A76956C3EAFB413
+3D5774A11D31AB39 8A1B083821F40CB4 7B4A38E32537DF62 950113646D1D6E03
+4DA8979A0041E8A9 3BC36E078F7515D7 5D0A12F27AD310D1 7F9D1A2E1EBE1327
+DA3A361B1C5157B1 DCDD7D20903D0C25 36833336D068F707 CE68341F79893389
+AB9090168DD05F34 43954B3252DC25E5 B438C2B67F98E5E9 10DCD78E3851A492
+DBC27AB5447822BF 9B3CDB65F82CA382 B67B7896167B4C84 BFCED1B0048EAC50
+A9119B60369FFEBD 1FFF7AC80904BF45 AC12FB171817EEE7 AF08DA9177DDA93D
+1B0CAB936E65C744 B559EB1D04E5E932 C37B45B3F8D6F2BA C3A9DC228CAAC9E9
+F3B8B6675A6507FF 9FC477DE4ED681DA 67378D8ECCEF96CB 6DD856D94D259236
+A319CE15B0B4DB31 073973751F12DD5E 8A8E849EB32781A5 E1925C71285279F5
+74C04BF1790C0EFE 4DDA48153C94938A 9D266D6A1CC0542C 7440FB816508C4FE
+13328503DF48229F D6BF7BAEE43CAC40 4838D65F6EF6748F 1E152328F3318DEA
+8F8419A348F296BF 72C8834A5957B511 D7A023A73260B45C 94EBC8ABCFB56DAE
+9FC10D0F989993E0 DE68A2355B93CAE6 A44CFE79AE538BBE 9D1D84FCCE371425
+51D2B1AB2DDFB636 2FD7E4B9E72CD38C 65CA5B96B7552210 DD69A0D8AB3B546D
+604D51B25FBF70E2 73AA8A564FB7AC9E 1A8C1E992B941148 AAC40A2703D9BEA0
+764DBEAE7FA4F3A6 1E99B96E70A9BE8B 2C5E9DEB57EF4743 3A938FEE32D29981
+26E6DB8FFDF5ADFE 469356C504EC9F9D C8763C5B08D1908C 3F6C6AF859D80055
+7F7CC39420A3A545 9BFB227EBDF4C5CE 89039D79D6FC5C5C 8FE88B57305E2AB6
+A09E8C8C35AB96DE FA7E393983325753 D6B6D0ECC617C699 DFEA21EA9E7557E3
+B67C1FA481680AF8 CA1E3785A9E724E5 1CFC8BED0D681639 D18D8549D140CAEA
+4ED0FE7E9DC91335 E4DBF0634473F5D2 1761F93A44D5AEFE 53898E4C3910DA55
+734DE8181F6EC39A 2680B122BAA28D97 298AF231C85BAFAB 7983EED3740847D5
+66C1A2A1A60CD889 9E17E49642A3E4C1 EDB454E7BADC0805 50B704CAB602C329
+4CC317FB9CDDD023 66B4835D9EAFEA22 219B97E26FFC81BD 261E4E4C0A333A9D
+1FE2CCA76517DB90 D7504DFA8816EDBB B9571FA04DC089C8 1DDC0325259B27DE
+CF3F4688801EB9AA F4F5D05C10CAB243 38B6525C21A42B0E 36F60E2BA4FA6800
+EB3593803173E0CE 9C4CD6257C5A3603 AF0C317D32ADAA8A 258E5A80C7204C4B
+8B889D624D44885D F4D14597E660F855 D4347F66EC8941C3 E699ED85B0DFB40D
+2472F6207C2D0484 C2A1E7B5B459AEB5 AB4F6451CC1D45EC 63767572AE3D6174
+A59E0BD101731A28 116D0016CB948F09 2CF9C8CA052F6E9F 0B090A7560A968E3
+ABEEDDB2DDE06FF1 58EFC10B06A2068D C6E57A78FBD986E0 2EAB8CA63CE802D7
+14A195640116F336 7C0828DD624EC390 D74BBE77E6116AC7 804456AF10F5FB53
+EBE9EA2ADF4321C7 03219A39EE587A30 49787FEF17AF9924 A1E9300CD8520548
+5B45E522E4B1B4EF B49C3B3995091A36 D4490AD526F14431 12A8F216AF9418C2
+001F837CC7350524 1877B51E57A764D5 A2853B80F17F58EE 993E1DE72D36D310
+B3598080CE64A656 252F59CF0D9F04BB D23C8E176D113600 1BDA0492E7E4586E
+21E0BD5026C619BF 3B097ADAF088F94E 8D14DEDB30BE846E F95CFFA23AF5F6F4
+3871700761B3F743 CA672B91E9E4FA16 64C8E531BFF53B55 241260ED4AD1E87D
+106C09B972D2E822 7FBA195410E5CA30 7884D9BC6CB569D8 0647DFEDCD894A29
+63573FF03E224774 4FC8E9560F91B123 1DB956E450275779 B8D91274B9E9D4FB
+A2EBEE47E2FBFCE1 D9F1F30CCD97FB09 EFED53D75FD64E6B 2E6D02C36017F67F
+A9AA4D20DB084E9B B64BE8D8B25396C1 70CB6AF7C2D5BCF0 98F076A4F7A2322E
+BF84470805E69B5F 94C3251F06F90CF3 3E003E616A6591E9 B925A6CD0421AFF3
+61BDD1307C66E300 BF8D5108E27E0D48 240AB57A8B888B20 FC87614BAF287E07
+EF02CDD06FFDB432 A1082C0466DF6C0A 8215E577001332C8 D39BB9C3A48DB6CF
+2738259634305C14 61CF4F94C97DF93D 1B6BACA2AE4E125B 758F450C88572E0B
+959F587D507A8359 B063E962E045F54D 60E8ED72C0DFF5D1 7B64978555326F9F
+FD080D236DA814BA 8C90FD9B083F4558 106F72FE81E2C590 7976033A39F7D952
+A4EC0132764CA04B 733EA705FAE4FA77 B4D8F77BC3E56167 9E21F4F903B33FD9
+9D765E419FB69F6D D30C088BA61EA5EF 5D94337FBFAF7F5B 1A4E4822EB4D7A59
+6FFE73E81B637FB3 DDF957BC36D8B9CA 64D0E29EEA8838B3 08DD9BDFD96B9F63
+087E79E5A57D1D13 E328E230E3E2B3FB 1C2559E30F0946BE 720BF5F26F4D2EAA
+B0774D261CC609DB 443F64EC5A371195 4112CF68649A260E D813F2FAB7F5C5CA
+660D3257380841EE 59AC2C7873F910A3 E846963877671A17 93B633ABFA3469F8
+C0C0F5A60EF4CDCF CAF21ECD4377B28C 57277707199B8175 506C11B9D90E8B1D
+D83CC2687A19255F 4A29C6465A314CD1 ED2DF21216235097 B5635C95FF7296E2
+22AF003AB672E811 52E762596BF68235 9AEBA33AC6ECC6B0 944F6DE09134DFB6
+6C47BEC883A7DE39 6AD047C430A12104 A5B1CFDBA0AB4067 7C45D833AFF07862
+5092EF950A16DA0B 9338E69C052B8E7B 455A4B4CFE30E3F5 6B02E63195AD0CF8
+6B17B224BAD6BF27 D1E0CCD25BB9C169 DE0C89A556B9AE70 50065E535A213CF6
+9C1169FA2777B874 78EDEFD694AF1EED 6DC93D9526A50E68 EE97F453F06791ED
+32AB0EDB696703D3 3A6853C7E70757A7 31865CED6120F37D 67FEF95D92607890
+1F2B1D1F15F6DC9C B69E38A8965C6B65 AA9119FF184CCCF4 F43C732873F24C13
+FB4A3D794A9A80D2 3550C2321FD6109C 371F77E76BB8417E 6BFA9AAE5EC05779
+CD04F3FF001A4778 E3273522064480CA 9F91508BFFCFC14A 049A7F41061A9E60
+FCB6BE43A9F2FE9B 08DE8A1C7797DA9B 8F9887E6078735A1 B5B4071DBFC73A66
+230E343DFBA08D33 43ED7F5A0FAE657D 3A88A0FBBCB05C63 21874B8B4D2DBC4F
+1BDEA12E35F6A8C9 53C065C6C8E63528 E34A1D250E7A8D6B D6B04D3B7651DD7E
+5E90277E7CB39E2D 2C046F22062DC67D B10BB459132D0A26 3FA9DDFB67E2F199
+0E09B88E1914F7AF 10E8B35AF3EEAB37 9EEDECA8E272B933 D4C718BC4AE8AE5F
+81536D601170FC20 91B534F885818A06 EC8177F83F900978 190E714FADA5156E
+B592BF39B0364963 89C350C893AE7DC1 AC042E70F8B383F2 B49B52E587A1EE60
+FB152FE3FF26DA89 3E666E6F69AE2C15 3B544EBE544C19F9 E805A1E290CF2456
+24B33C9D7ED25117 E74733427B72F0C1 0A804D18B7097475 57E3306D881EDB4F
+4AE7D6A36EB5DBCB 2D8D5432157064C8 D1E649DE1E7F268B 8A328A1CEDFE552C
+07A3AEC79624C7DA 84547DDC3E203C94 990A98FD5071D263 1A4FF12616EEFC89
+F6F7FD1431714200 30C05B1BA332F41C 8D2636B81555A786 46C9FEB55D120902
+CCEC0A73B49C9921 4E9D2827355FC492 19EBB029435DCB0F 4659D2B743848A2C
+963EF2C96B33BE31 74F85198B05A2E7D 5A0F544DD2B1FB18 03727073C2E134B1
+C7F6AA2DE59AEA61 352787BAA0D7C22F 9853EAB63B5E0B35 ABBDCDD7ED5C0860
+CF05DAF5AC8D77B0 49CAD48CEBF4A71E 7A4C10EC2158C4A6 D9E92AA246BF719E
+13AE978D09FE5557 730499AF921549FF 4E4B705B92903BA4 FF577222C14F0A3A
+55B6344CF97AAFAE B862225B055B6960 CAC09AFBDDD2CDB4 DAF8E9829FE96B5F
+B5FDFC5D3132C498 310CB380DB6F7503 E87FBB46217A360E 2102AE466EBB1148
+F8549E1A3AA5E00D 07A69AFDCC42261A C4C118BFE78FEAAE F9F4892ED96BD438
+1AF3DBE25D8F45DA F5B4B0B0D2DEEEB4 962ACEEFA82E1C84 046E3ECAAF453CE9
+F05D129681949A4C 964781CE734B3C84 9C2ED44081CE5FBD 522E23F3925E319E
+177E00F9FC32F791 2BC60A63A6F3B3F2 222BBFAE61725606 486289DDCC3D6780
+7DC7785B8EFDFC80 8AF38731C02BA980 1FAB64EA29A2DDF7 E4D9429322CD065A
+9DA058C67844F20C 24C0E332B70019B0 233003B5A6CFE6AD D586BD01C5C217F6
+5E5637885F29BC2B 7EBA726D8C94094B 0A56A5F0BFE39272 D79476A84EE20D06
+9E4C1269BAA4BF37 17EFEE45B0DEE640 1D95B0A5FCF90BC6 93CBE0B699C2585D
+65FA4F227A2B6D79 D5F9E858292504D5 C2B5A03F71471A6F 59300222B4561E00
+CE2F8642CA0712DC 7CA9723FBB2E8988 2785338347F2BA08 C61BB3A141E50E8C
+150F361DAB9DEC26 9F6A419D382595F4 64A53DC924FE7AC9 142DE49FFF7A7C3D
+0C335248857FA9E7 0A9C32D5EAE45305 E6C42178C4BBB92E 71F1CE2490D20B07
+F1BCC3D275AFE51A E728E8C83C334074 96FBF83A12884624 81A1549FD6573DA5
+5FA7867CAF35E149 56986E2EF3ED091B 917F1DD5F8886C61 D20D8C88C8FFE65F
+31D71DCE64B2C310 F165B587DF898190 A57E6339DD2CF3A0 1EF6E6DBB1961EC9
+70CC73D90BC26E24 E21A6B35DF0C3AD7 003A93D8B2806962 1C99DED33CB890A1
+CF3145DE0ADD4289 D0E4427A5514FB72 77C621CC9FB3A483 67A34DAC4356550B
+F8D626AAAF278509
+""".split()]
+POLYGLOT_PIECES = {  # the 64 square keys of each piece, black kinds come first
+    kind(color): POLYGLOT_RANDOM[offset : offset + 64]
+    for n, kind in enumerate((Pawn, Knight, Bishop, Rook, Queen, King))
+    for color, offset in (("black", 128 * n), ("white", 128 * n + 64))
+}
+POLYGLOT_CASTLING = 768  # K, Q, k, q in the order of the castling bits
+POLYGLOT_EP = 772
+POLYGLOT_WHITE_TO_MOVE = 780
+
+
+def polyglot_key(board: Chessboard) -> int:
+    # The position hash used by Polyglot books. Like Chessboard.key it only
+    # holds the en passant file when a pawn can really take
+    key = 0
+    squares = board.squares
+    for square in board.pieces["white"]:
+        key ^= POLYGLOT_PIECES[squares[square]][square]
+    for square in board.pieces["black"]:
+        key ^= POLYGLOT_PIECES[squares[square]][square]
+    for bit in range(4):
+        if board.castling >> bit & 1:
+            key ^= POLYGLOT_RANDOM[POLYGLOT_CASTLING + bit]
+    if board.ep_capturable():
+        key ^= POLYGLOT_RANDOM[POLYGLOT_EP + (board.ep_square & 7)]
+    if board.white_turn == True:
+        key ^= POLYGLOT_RANDOM[POLYGLOT_WHITE_TO_MOVE]
+    return key
+
+
+class OpeningBook:
+    # A Polyglot book: 16-byte big-endian entries of key, move, weight and
+    # learn, sorted by key. The file is memory mapped and searched in place
+    entry_size = 16
+    entry = struct.Struct(">QHHI")
+    entry_key = struct.Struct(">Q")
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        self.count = size // self.entry_size
+        self.data = b""
+        if self.count > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self) -> None:
+        if self.count > 0:
+            self.data.close()
+        self.file.close()
+
+    def lookup(self, key: int) -> list:
+        # (move code, weight) of every entry for the key
+        data, size = self.data, self.entry_size
+        read_key = self.entry_key.unpack_from
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if read_key(data, middle * size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        entries = []
+        while low < self.count:
+            entry_key, move, weight, learn = self.entry.unpack_from(data, low * size)
+            if entry_key != key:
+                break
+            entries.append((move, weight))
+            low += 1
+        return entries
+
+    def moves(self, board: Chessboard) -> list:
+        # The legal book moves as ((from, to, promotion class), weight)
+        entries = self.lookup(polyglot_key(board))
+        if not entries:  # out of book, no need to generate the moves
+            return []
+        legal = [
+            (move_from, move_to, None if promotion == None else type(promotion))
+            for move_from, move_to, promotion in legal_moves(board)
+        ]
+        moves = []
+        for code, weight in entries:
+            move = book_move(board, code)
+            if move in legal:  # a stale or colliding entry is skipped
+                moves.append((move, weight))
+        return moves
+
+    def choose(self, board: Chessboard, rng: random.Random = None):
+        # A move picked by weight, or the heaviest one without rng
+        moves = [(move, weight) for move, weight in self.moves(board) if weight > 0]
+        if not moves:
+            return None
+        if rng == None:
+            return max(moves, key=lambda entry: entry[1])[0]
+        pick = rng.randrange(sum(weight for move, weight in moves))
+        for move, weight in moves:
+            if pick < weight:
+                return move
+            pick -= weight
+
+
+def book_move(board: Chessboard, code: int) -> tuple:
+    # Polyglot move: to in bits 0-5, from in bits 6-11, promotion in 12-14,
+    # castling written as the king taking its own rook
+    move_from, move_to = code >> 6 & 63, code & 63
+    if isinstance(board.squares[move_from], King) and (move_from, move_to) in (
+        (4, 7),
+        (4, 0),
+        (60, 63),
+        (60, 56),
+    ):
+        move_to = move_from + 2 if move_to > move_from else move_from - 2
+    return move_from, move_to, PROMOTION_CODES[code >> 12 & 7]
+
+
+def book_code(board: Chessboard, move: tuple) -> int:
+    move_from, move_to, promotion = move
+    if (
+        isinstance(board.squares[move_from], King)
+        and abs((move_to & 7) - (move_from & 7)) == 2
+    ):
+        move_to = move_from + 3 if move_to > move_from else move_from - 4
+    return move_to | move_from << 6 | PROMOTION_CODES.index(promotion) << 12
+
+
+class GameState:
+
+    def __init__(
+        self,
+        fen: str = None,
+        table: TranspositionTable = None,
+        pgn: PGNWriter = None,
+        cache: MoveCache = None,
+    ):
+        if fen == None:
+            self.board = start_game(Chessboard())
+        else:
+            self.board = Chessboard.from_fen(fen)
+        self.table = table
+        self.pgn = pgn
+        if fen != None and pgn != None:
+            pgn.set_position(self.board)
+        self.cache = cache if cache != None else MoveCache()
+        self.moves = []
+        self.status = self.position()[1]
+        self.board.check = self.status in (STATUS_CHECK, STATUS_CHECKMATE)
+
+    @property
+    def white_turn(self) -> bool:
+        return self.board.white_turn
+
+    def position(self) -> tuple:
+        # The legal moves and the game status, worked out once per position
+        entry = self.cache.get(self.board.key)
+        if entry != None:
+            return entry
+        board = self.board
+        color = "white" if board.white_turn == True else "black"
+        moves = [
+            (move_from, move_to, None if promotion == None else type(promotion))
+            for move_from, move_to, promotion in legal_moves(board)
+        ]
+        check = is_attacked(board.white_turn, board.king_square[color], board)
+        if moves:
+            status = STATUS_CHECK if check else STATUS_PLAYING
+        else:
+            status = STATUS_CHECKMATE if check else STATUS_STALEMATE
+        self.cache.put(board.key, moves, status)
+        if self.table != None:
+            self.table.store_status(board.key, status)
+        return moves, status
+
+    def legal_moves(self) -> list:
+        return list(self.position()[0])
+
+    def is_promotion(self, move_from: int, move_to: int) -> bool:
+        return any(
+            move[0] == move_from and move[1] == move_to and move[2] != None
+            for move in self.position()[0]
+        )
+
+    def push(self, move, promotion=None) -> int:
+        if isinstance(move, str):  # coordinate notation, e.g. "e2e4" or "e7e8q"
+            if len(move) not in (4, 5) or sq_pattern.search(move[:2]) == None:
+                raise ValueError("Invalid square")
+            if sq_pattern.search(move[2:4]) == None:
+                raise ValueError("Invalid square")
+            move_from, move_to = square_index(move[:2]), square_index(move[2:4])
+            if len(move) == 5 and promotion == None:
+                promotion = move[4]
+        else:
+            move_from, move_to = move[0], move[1]
+            if len(move) > 2 and promotion == None:
+                promotion = move[2]
+        if isinstance(promotion, Piece):  # as yielded by legal_moves()
+            promotion = type(promotion)
+        if isinstance(promotion, type):
+            if promotion not in PROMOTIONS:
+                raise ValueError("Invalid promotion")
+            promotion = PROMOTIONS[promotion]
+
+        if self.status == STATUS_CHECKMATE or self.status == STATUS_STALEMATE:
+            raise ValueError("The game is over")
+        piece = self.board.squares[move_from]
+        color = "white" if self.board.white_turn == True else "black"
+        if piece == " " or piece.color != color:
+            raise ValueError(f"{color.capitalize()} to move")
+        if isinstance(piece, Pawn) and (move_to >> 3 == 0 or move_to >> 3 == 7):
+            promotion = piece.promote(promotion or "q")
+        else:
+            promotion = None
+        if (
+            move_from,
+            move_to,
+            None if promotion == None else type(promotion),
+        ) not in self.position()[0]:
+            if piece.move(move_from, move_to, self.board) == 0:
+                raise ValueError("Invalid move")
+            raise ValueError("Illegal move")
+        if self.pgn != None:
+            self.pgn.add_move(move_san(self.board, move_from, move_to, promotion))
+        self.board.make_move(move_from, move_to, promotion)
+        self.moves.append(
+            (move_from, move_to, None if promotion == None else type(promotion))
+        )
+
+        self.status = self.position()[1]
+        self.board.check = self.status in (STATUS_CHECK, STATUS_CHECKMATE)
+        if self.pgn != None:
+            if self.status == STATUS_CHECK:
+                self.pgn.mark_check()
+            elif self.status == STATUS_CHECKMATE:
+                self.pgn.mark_checkmate()
+            if self.result() != "*":
+                self.pgn.set_result(self.result())
+                self.pgn.flush()
+        return self.status
+
+    def pop(self):
+        move = self.moves.pop()
+        self.board.unmake_move()
+        if self.pgn != None:
+            self.pgn.take_back()
+        self.status = self.position()[1]
+        self.board.check = self.status in (STATUS_CHECK, STATUS_CHECKMATE)
+        return move
+
+    def result(self) -> str:
+        if self.status == STATUS_CHECKMATE:
+            return "0-1" if self.board.white_turn == True else "1-0"
+        if self.status == STATUS_STALEMATE:
+            return "1/2-1/2"
+        return "*"
+
+
+class TerminalRenderer:
+    # Paints the whole board once, then only the squares that changed, using
+    # ANSI cursor addressing. Output that is not a terminal gets plain boards
+    material_row = 21
+    message_row = 23  # first line below the board
+    frame = None  # the empty board, built once
+
+    def __init__(self, out=None):
+        self.out = out if out != None else sys.stdout
+        self.ansi = self.out.isatty()
+        self.shown = None  # glyph painted on each square
+        self.last = None  # last history record painted
+        self.ply = 0
+
+    @staticmethod
+    def locate(square: int) -> str:
+        return f"\x1b[{4 + 2 * (7 - (square >> 3))};{5 + 4 * (square & 7)}H"
+
+    def draw(self, board: Chessboard) -> None:
+        if self.ansi == False:
+            print(board, file=self.out)
+            return
+        if self.shown == None:
+            self.repaint(board)
+            return
+        history = board.history
+        if self.ply <= len(history) and (
+            self.ply == 0 or history[self.ply - 1] is self.last
+        ):  # repaint the squares touched by the moves made since
+            squares = set()
+            for record in history[self.ply :]:
+                squares.update((record[0], record[1], record[4]))
+                if record[5] != None:  # castling rook
+                    squares.update((record[5], record[6]))
+        else:  # moves were taken back, compare every square
+            squares = range(64)
+
+        parts = ["\x1b7"]  # save the cursor
+        for square in squares:
+            glyph = str(board.squares[square])
+            if glyph != self.shown[square]:
+                parts.append(self.locate(square) + glyph)
+                self.shown[square] = glyph
+        parts.append(
+            f"\x1b[{self.material_row};5H{board.material_balance()}\x1b[K\x1b8"
+        )
+        self.out.write("".join(parts))
+        self.out.flush()
+        self.remember(board)
+
+    def repaint(self, board: Chessboard) -> None:
+        if TerminalRenderer.frame == None:
+            TerminalRenderer.frame = str(Chessboard())
+        parts = ["\x1b[2J\x1b[H", TerminalRenderer.frame]
+        self.shown = [" "] * 64
+        for color in ("white", "black"):
+            for square in board.pieces[color]:
+                self.shown[square] = str(board.squares[square])
+                parts.append(self.locate(square) + self.shown[square])
+        parts.append(
+            f"\x1b[{self.material_row};5H{board.material_balance()}\x1b[K"
+            f"\x1b[{self.message_row};1H"
+        )
+        self.out.write("".join(parts))
+        self.out.flush()
+        self.remember(board)
+
+    def remember(self, board: Chessboard) -> None:
+        self.ply = len(board.history)
+        self.last = board.history[-1] if board.history else None
+
+    def clear_messages(self) -> None:
+        if self.ansi == True:
+            self.out.write(f"\x1b[{self.message_row};1H\x1b[J")
+
+
+def ask_promotion() -> str:
     while True:
-        if white_turn == True:
-            turn += 1
+        promote = (
+            input("Promote to (N=knight, B=bishop, R=rook, Q=queen): ").lower().strip()
+        )
+        if promote in ["n", "b", "r", "q"]:
+            return promote
+
+
+def main(
+    hash_mb: int = 16,
+    pgn_flush: int = 0,
+    vs_engine: str = None,
+    engine_depth: int = None,
+    movetime: int = None,
+    clock: int = None,
+    increment: int = 0,
+    book_path: str = None,
+):
+    headers = {}
+    if vs_engine != None:
+        headers["White" if vs_engine == "white" else "Black"] = "chess_sim engine"
+    state = GameState(
+        table=TranspositionTable(hash_mb),
+        pgn=PGNWriter("chess_sim_PGN.txt", headers, flush_every=pgn_flush),
+    )
+    engine = Engine(state.table) if vs_engine != None else None
+    book = OpeningBook(book_path) if book_path != None else None
+    book_rng = random.Random()
+    game = state.board
+    renderer = TerminalRenderer()
+
+    while True:
+        renderer.draw(game)
+        if engine != None and game.white_turn == (vs_engine == "white"):
+            lines = []
+            if clock != None:
+                budget = move_budget(clock, increment)
+            else:
+                budget = movetime
+            if budget == None and engine_depth == None:
+                engine_depth = 3
+            start = time.perf_counter()
+            move = book.choose(game, book_rng) if book != None else None
+            if move != None:
+                lines.append("book move")
+            else:
+                move, score = engine.search(
+                    game, engine_depth or MAX_DEPTH, budget, report=lines.append
+                )
+            if clock != None:
+                clock += increment - int((time.perf_counter() - start) * 1000)
+            renderer.clear_messages()
+            print("\n".join(lines))
+            move_from, move_to = move[0], move[1]
+            status = state.push(move)
+            print_move(game, move_from, move_to, status)
+            if state.result() != "*":
+                renderer.draw(game)
+                break
+            continue
 
-        print(game)
         while True:
             try:
                 move_from, move_to = (
@@ -612,13 +1913,14 @@ def main():
                 )
                 break
             except KeyboardInterrupt:
+                state.pgn.flush()
                 sys.exit()
             except:
                 continue
 
-        os.system("cls")
+        renderer.clear_messages()
         if game.check == True:
-            if white_turn == True:
+            if game.white_turn == True:
                 print("White is in check!")
             else:
                 print("Black is in check!")
@@ -628,443 +1930,1105 @@ def main():
         ):  # Check for valid coordinates
             print("Invalid square")
             continue
+        move_from, move_to = square_index(move_from), square_index(move_to)
+
+        promotion = None
+        if state.is_promotion(move_from, move_to):
+            promotion = ask_promotion()
+        try:
+            status = state.push((move_from, move_to), promotion)
+        except ValueError as error:
+            print(error)
+            continue
 
-        if white_turn == True:
-            if (
-                game.squares[move_from] == " "
-                or game.squares[move_from].color == "black"
-            ):
-                print("White to move")
-                continue
-        else:
-            if (
-                game.squares[move_from] == " "
-                or game.squares[move_from].color == "white"
-            ):
-                print("Black to move")
-                continue
-
-        if game.squares[move_from].move(move_from, move_to, game):
-            if not is_legal(move_from, move_to, game):
-                print("Illegal move")
-                continue
-
-        match game.squares[move_from].move(move_from, move_to, game):
-            case 0:
-                print("Invalid move")
-                continue
-            case 2:  # enable en passant
-                with open("chess_sim_PGN.txt", "a", encoding="utf-8") as pgn:
-                    if white_turn == True:
-                        pgn.write(f"{turn}.{move_to}")
-                    else:
-                        pgn.write(f" {move_to} ")
-                print(f"{game.squares[move_from]} {move_to}")
-                game.squares[move_from].en_passant = 1
-                if sq_pattern.search(
-                    chr(ord(move_to[0]) - 1) + move_to[1]
-                ) != None and isinstance(
-                    game.squares[chr(ord(move_to[0]) - 1) + move_to[1]], Pawn
-                ):
-                    game.squares[chr(ord(move_to[0]) - 1) + move_to[1]].en_passant = 1
-                    game.en_passant = True
-                if sq_pattern.search(
-                    chr(ord(move_to[0]) + 1) + move_to[1]
-                ) != None and isinstance(
-                    game.squares[chr(ord(move_to[0]) + 1) + move_to[1]], Pawn
-                ):
-                    game.squares[chr(ord(move_to[0]) + 1) + move_to[1]].en_passant = 1
-                    game.en_passant = True
-            case 3:  # en passant
-                with open("chess_sim_PGN.txt", "a", encoding="utf-8") as pgn:
-                    if white_turn == True:
-                        pgn.write(f"{turn}.{move_from[0]}x{move_to}")
-                    else:
-                        pgn.write(f" {move_from[0]}x{move_to} ")
-                print(f"{game.squares[move_from]} {move_to}")
-                game.squares[move_to[0] + move_from[1]].on_the_board = 0
-                game.squares[move_to[0] + move_from[1]] = " "
-            case 4:  # castling short
-                with open("chess_sim_PGN.txt", "a", encoding="utf-8") as pgn:
-                    if white_turn == True:
-                        pgn.write(f"{turn}.O-O")
-                    else:
-                        pgn.write(f" O-O ")
-                print("O-O")
-                if move_from == "e1":
-                    if isinstance(game.squares["h1"], Piece):
-                        game.squares["h1"].position = "f1"
-                    game.squares["f1"] = game.squares["h1"]
-                    game.squares["h1"] = " "
-                else:
-                    if isinstance(game.squares["h8"], Piece):
-                        game.squares["h8"].position = "f8"
-                    game.squares["f8"] = game.squares["h8"]
-                    game.squares["h8"] = " "
-            case 5:  # castling long
-                with open("chess_sim_PGN.txt", "a", encoding="utf-8") as pgn:
-                    if white_turn == True:
-                        pgn.write(f"{turn}.O-O-O")
-                    else:
-                        pgn.write(f" O-O-O ")
-                print("O-O-O")
-                if move_from == "e1":
-                    if isinstance(game.squares["a1"], Piece):
-                        game.squares["a1"].position = "d1"
-                    game.squares["d1"] = game.squares["a1"]
-                    game.squares["a1"] = " "
-                else:
-                    if isinstance(game.squares["a8"], Piece):
-                        game.squares["a8"].position = "d8"
-                    game.squares["d8"] = game.squares["a8"]
-                    game.squares["a8"] = " "
-            case 1:
-                with open("chess_sim_PGN.txt", "a", encoding="utf-8") as pgn:
-                    if white_turn == True:
-                        if isinstance(game.squares[move_from], Pawn):
-                            if game.squares[move_to] != " ":
-                                pgn.write(f"{turn}.{move_from[0]}x{move_to}")
-                            else:
-                                pgn.write(f"{turn}.{move_to}")
-                        else:
-                            if game.squares[move_to] != " ":
-                                pgn.write(f"{turn}.{game.squares[move_from]}x{move_to}")
-                            else:
-                                pgn.write(f"{turn}.{game.squares[move_from]}{move_to}")
-                    else:
-                        if isinstance(game.squares[move_from], Pawn):
-                            if game.squares[move_to] != " ":
-                                pgn.write(f" {move_from[0]}x{move_to} ")
-                            else:
-                                pgn.write(f" {move_to} ")
-                        else:
-                            if game.squares[move_to] != " ":
-                                pgn.write(f" {game.squares[move_from]}x{move_to} ")
-                            else:
-                                pgn.write(f" {game.squares[move_from]}{move_to} ")
-                print(f"{game.squares[move_from]} {move_to}")
-
-        if game.squares[move_to] != " ":
-            game.squares[move_to].on_the_board = 0  # Eliminate the piece that was taken
-        if isinstance(game.squares[move_from], King) or isinstance(
-            game.squares[move_from], Rook
-        ):
-            game.squares[move_from].can_castle = 0
-        game.squares[move_from].position = move_to
-        game.squares[move_to] = game.squares[move_from]
-        game.squares[move_from] = " "
-
-        if isinstance(game.squares[move_to], Pawn) and (
-            move_to[1] == "1" or move_to[1] == "8"
-        ):  # promotion of pawns that reach the last rank
-            game.squares[move_to].on_the_board = 0
-            game.squares[move_to] = game.squares[move_to].promote(move_to, game)
-            pieces.append(game.squares[move_to])
-            if white_turn == True:
-                if isinstance(game.squares[move_to], Queen):
-                    with open("chess_sim_PGN.txt", "a", encoding="utf-8") as pgn:
-                        pgn.write("=Q")
-                elif isinstance(game.squares[move_to], Rook):
-                    with open("chess_sim_PGN.txt", "a", encoding="utf-8") as pgn:
-                        pgn.write("=R")
-                elif isinstance(game.squares[move_to], Knight):
-                    with open("chess_sim_PGN.txt", "a", encoding="utf-8") as pgn:
-                        pgn.write("=N")
-                elif isinstance(game.squares[move_to], Bishop):
-                    with open("chess_sim_PGN.txt", "a", encoding="utf-8") as pgn:
-                        pgn.write("=B")
-            else:
-                if isinstance(game.squares[move_to], Queen):
-                    with open("chess_sim_PGN.txt", "r", encoding="utf-8") as file:
-                        reader = file.read()
-                    reader = reader[:-1] + "=Q "
-                    with open("chess_sim_PGN.txt", "w", encoding="utf-8") as pgn:
-                        pgn.write(reader)
-                elif isinstance(game.squares[move_to], Rook):
-                    with open("chess_sim_PGN.txt", "r", encoding="utf-8") as file:
-                        reader = file.read()
-                    reader = reader[:-1] + "=R "
-                    with open("chess_sim_PGN.txt", "w", encoding="utf-8") as pgn:
-                        pgn.write(reader)
-                elif isinstance(game.squares[move_to], Knight):
-                    with open("chess_sim_PGN.txt", "r", encoding="utf-8") as file:
-                        reader = file.read()
-                    reader = reader[:-1] + "=N "
-                    with open("chess_sim_PGN.txt", "w", encoding="utf-8") as pgn:
-                        pgn.write(reader)
-                elif isinstance(game.squares[move_to], Bishop):
-                    with open("chess_sim_PGN.txt", "r", encoding="utf-8") as file:
-                        reader = file.read()
-                    reader = reader[:-1] + "=B "
-                    with open("chess_sim_PGN.txt", "w", encoding="utf-8") as pgn:
-                        pgn.write(reader)
-
-        game.check = is_check(white_turn, game)
-        if game.check == True:
-            with open("chess_sim_PGN.txt", "a", encoding="utf-8") as pgn:
-                if white_turn == True:
-                    pgn.write("+")
-                else:
-                    pgn.write("+ ")
-            print("Check!")
-
-        if is_stalemate(white_turn, game):
-            with open("chess_sim_PGN.txt", "a", encoding="utf-8") as pgn:
-                pgn.write(" 1/2 - 1/2")
-            print("Stalemate")
+        print_move(game, move_from, move_to, status)
+        if state.result() != "*":
+            renderer.draw(game)
             break
 
-        if white_turn == True:
-            if is_checkmate(white_turn, game):
-                with open("chess_sim_PGN.txt", "r", encoding="utf-8") as file:
-                    reader = file.read()
-                reader = reader[:-1] + "# 1-0"
-                with open("chess_sim_PGN.txt", "w", encoding="utf-8") as pgn:
-                    pgn.write(reader)
-                print("White wins!")
-                print(game)
-                break
-            white_turn = False
-        else:
-            if is_checkmate(white_turn, game):
-                with open("chess_sim_PGN.txt", "r", encoding="utf-8") as file:
-                    reader = file.read()
-                reader = reader[:-3] + "# 0-1"
-                with open("chess_sim_PGN.txt", "w", encoding="utf-8") as pgn:
-                    pgn.write(reader)
-                print("Black wins!")
-                print(game)
-                break
-            white_turn = True
-
-        if (
-            game.en_passant == True and en_passant_count == 1
-        ):  # resets en_passant on the board and on Pawns
-            game.en_passant = False
-            en_passant_count = 0
-            for piece in pieces:
-                if isinstance(piece, Pawn) and piece.en_passant == 1:
-                    piece.en_passant = 0
-        if game.en_passant == True and en_passant_count == 0:
-            en_passant_count = 1
-
-
-def start_game(game):
-    pieces = []
-    for square in game.squares:
-        if square[1] == "2":
-            pieces.append(Pawn("white", square, game))
-        elif square[1] == "7":
-            pieces.append(Pawn("black", square, game))
-        elif square[1] in ("1", "8"):
-            if square[0] in ("a", "h"):
-                (
-                    pieces.append(Rook("white", square, game))
-                    if square[1] == "1"
-                    else pieces.append(Rook("black", square, game))
-                )
-            elif square[0] in ("b", "g"):
-                (
-                    pieces.append(Knight("white", square, game))
-                    if square[1] == "1"
-                    else pieces.append(Knight("black", square, game))
-                )
-            elif square[0] in ("c", "f"):
-                (
-                    pieces.append(Bishop("white", square, game))
-                    if square[1] == "1"
-                    else pieces.append(Bishop("black", square, game))
-                )
-            elif square[0] == "d":
-                (
-                    pieces.append(Queen("white", square, game))
-                    if square[1] == "1"
-                    else pieces.append(Queen("black", square, game))
-                )
-            elif square[0] == "e":
-                (
-                    pieces.append(King("white", square, game))
-                    if square[1] == "1"
-                    else pieces.append(King("black", square, game))
-                )
-    return pieces
-
 
-def is_legal(move_from: str, move_to: str, board: Chessboard) -> bool:
-    game_legal = copy.deepcopy(board)
-    pieces_legal = []
+def print_move(game: Chessboard, move_from: int, move_to: int, status: int) -> None:
+    if isinstance(game.squares[move_to], King) and abs(move_to - move_from) == 2:
+        print("O-O" if move_to > move_from else "O-O-O")
+    else:
+        print(f"{game.squares[move_to]} {square_name(move_to)}")
+    if status == STATUS_CHECK:
+        print("Check!")
+    elif status == STATUS_STALEMATE:
+        print("Stalemate")
+    elif status == STATUS_CHECKMATE:
+        print("White wins!" if game.white_turn == False else "Black wins!")
+
+
+def start_game(game: Chessboard) -> Chessboard:
+    back_rank = (Rook, Knight, Bishop, Queen, King, Bishop, Knight, Rook)
+    for col, kind in enumerate(back_rank):
+        game.put(kind("white"), col)
+        game.put(Pawn("white"), 8 + col)
+        game.put(Pawn("black"), 48 + col)
+        game.put(kind("black"), 56 + col)
+    game.castling = 15
+    game.zobrist_key = game.compute_key()
+    return game
+
+
+def is_legal(move_from: int, move_to: int, board: Chessboard) -> bool:
+    piece = board.squares[move_from]
+    if not piece.move(move_from, move_to, board):
+        return True
 
-    for square in game_legal.squares.keys():
-        if game_legal.squares[square] != " ":
-            pieces_legal.append(game_legal.squares[square])
-        if isinstance(game_legal.squares[square], King):
-            if game_legal.squares[square].color == "white":
-                wking_legal = game_legal.squares[square].position
+    board.make_move(move_from, move_to)
+    king_pos = board.king_square[piece.color]
+    legal = not is_attacked(piece.color == "white", king_pos, board)
+    board.unmake_move()
+    return legal
+
+
+def move_san(board: Chessboard, move_from: int, move_to: int, promotion=None) -> str:
+    piece = board.squares[move_from]
+    if isinstance(piece, King) and abs((move_to & 7) - (move_from & 7)) == 2:
+        return "O-O" if move_to > move_from else "O-O-O"
+    capture = board.squares[move_to] != " " or (
+        isinstance(piece, Pawn) and (move_from & 7) != (move_to & 7)
+    )
+    if isinstance(piece, Pawn):
+        san = square_name(move_from)[0] if capture == True else ""
+    else:
+        san = PIECE_LETTERS[type(piece)]
+        others = [  # pieces of the same kind that can reach the same square
+            square
+            for square in list(board.pieces[piece.color])
+            if square != move_from
+            and type(board.squares[square]) == type(piece)
+            and board.squares[square].move(square, move_to, board)
+            and is_legal(square, move_to, board)
+        ]
+        if others:
+            if all((square & 7) != (move_from & 7) for square in others):
+                san += square_name(move_from)[0]
+            elif all((square >> 3) != (move_from >> 3) for square in others):
+                san += square_name(move_from)[1]
             else:
-                bking_legal = game_legal.squares[square].position
-
-    if game_legal.squares[move_from].color == "white" and game_legal.squares[
-        move_from
-    ].move(move_from, move_to, board):
-        if game_legal.squares[move_to] != " ":
-            game_legal.squares[move_to].on_the_board = 0
-        if isinstance(game_legal.squares[move_from], King):
-            wking_legal = move_to
-        game_legal.squares[move_from].position = move_to
-        game_legal.squares[move_to] = game_legal.squares[move_from]
-        game_legal.squares[move_from] = " "
-        for piece in pieces_legal:
-            if piece.color == "black" and piece.on_the_board == 1:
-                if piece.move(piece.position, wking_legal, game_legal):
-                    return False
-    elif game_legal.squares[move_from].color == "black" and game_legal.squares[
-        move_from
-    ].move(move_from, move_to, board):
-        if game_legal.squares[move_to] != " ":
-            game_legal.squares[move_to].on_the_board = 0
-        if isinstance(game_legal.squares[move_from], King):
-            bking_legal = move_to
-        game_legal.squares[move_from].position = move_to
-        game_legal.squares[move_to] = game_legal.squares[move_from]
-        game_legal.squares[move_from] = " "
-        for piece in pieces_legal:
-            if piece.color == "white" and piece.on_the_board == 1:
-                if piece.move(piece.position, bking_legal, game_legal):
-                    return False
+                san += square_name(move_from)
+    if capture == True:
+        san += "x"
+    san += square_name(move_to)
+    if promotion != None:
+        san += "=" + PIECE_LETTERS[type(promotion)]
+    return san
 
-    return True
 
+def is_attacked(turn: bool, square: int, board: Chessboard) -> bool:
+    if turn == True:
+        attacker, defender = "black", "white"
+    else:
+        attacker, defender = "white", "black"
+    pieces = board.bitboards[attacker]
+    if (
+        KNIGHT_ATTACKS[square] & pieces[Knight]
+        or KING_ATTACKS[square] & pieces[King]
+        or PAWN_ATTACKS[defender][square] & pieces[Pawn]
+    ):
+        return True
 
-def is_check(turn: bool, board: Chessboard) -> bool:
-    if turn == True:  # white turn
-        for square in board.squares.keys():
-            if (
-                isinstance(board.squares[square], King)
-                and board.squares[square].color == "black"
-            ):
-                bkp = board.squares[square].position
-                break
-        for square in board.squares.keys():
-            if (
-                isinstance(board.squares[square], Piece)
-                and board.squares[square].color == "white"
-                and board.squares[square].on_the_board == 1
-            ):
-                if board.squares[square].move(
-                    board.squares[square].position, bkp, board
-                ):
+    straight = pieces[Rook] | pieces[Queen]
+    diagonal = pieces[Bishop] | pieces[Queen]
+    occupied = board.occupied["white"] | board.occupied["black"]
+    for direction in range(8):
+        sliders = straight if direction < 4 else diagonal
+        if not sliders & RAY_MASKS[square][direction]:
+            continue
+        for target in RAYS[square][direction]:  # look outward for the first piece
+            if occupied >> target & 1:
+                if sliders >> target & 1:
                     return True
-    else:  # black turn
-        for square in board.squares.keys():
-            if (
-                isinstance(board.squares[square], King)
-                and board.squares[square].color == "white"
-            ):
-                wkp = board.squares[square].position
                 break
-        for square in board.squares.keys():
-            if (
-                isinstance(board.squares[square], Piece)
-                and board.squares[square].color == "black"
-                and board.squares[square].on_the_board == 1
-            ):
-                if board.squares[square].move(
-                    board.squares[square].position, wkp, board
-                ):
-                    return True
     return False
 
 
-def is_checkmate(turn: bool, board: Chessboard) -> bool:
-    if board.check == False:
-        return False
-
-    if turn == True:  # white turn
-        for square in board.squares.keys():
+def pseudo_legal_moves(board: Chessboard):
+    color = "white" if board.white_turn == True else "black"
+    for square in list(board.pieces[color]):
+        piece = board.squares[square]
+        for move_to in piece.generate_moves(board, square):
+            if isinstance(piece, Pawn) and (move_to >> 3 == 0 or move_to >> 3 == 7):
+                for kind in PROMOTIONS:
+                    yield square, move_to, kind(color)
+            else:
+                yield square, move_to, None
+
+
+def legal_moves(board: Chessboard, color: str = None):
+    # Finds the checkers and the pinned pieces first, then yields only legal
+    # (from, to, promotion) moves. King moves and en passant are the only ones
+    # checked with an attack test
+    if color == None:
+        color = "white" if board.white_turn == True else "black"
+    enemy = "black" if color == "white" else "white"
+    theirs = board.bitboards[enemy]
+    king_pos = board.king_square[color]
+    occupied = board.occupied["white"] | board.occupied["black"]
+    straight = theirs[Rook] | theirs[Queen]
+    diagonal = theirs[Bishop] | theirs[Queen]
+
+    checkers = KNIGHT_ATTACKS[king_pos] & theirs[Knight]
+    checkers |= PAWN_ATTACKS[color][king_pos] & theirs[Pawn]
+    evasions = checkers  # the squares that capture or block a single check
+    pinned = {}  # pinned square: the line it may still move along
+    for direction in range(8):
+        sliders = straight if direction < 4 else diagonal
+        if not sliders & RAY_MASKS[king_pos][direction]:
+            continue
+        line, blocker = 0, None
+        for target in RAYS[king_pos][direction]:
+            line |= 1 << target
+            if not occupied >> target & 1:
+                continue
+            if sliders >> target & 1:
+                if blocker == None:
+                    checkers |= 1 << target
+                    evasions |= line
+                else:
+                    pinned[blocker] = line
+                break
+            if blocker != None or board.occupied[enemy] >> target & 1:
+                break
+            blocker = target
+    if checkers == 0:
+        evasions = -1  # every square
+
+    king = board.squares[king_pos]
+    targets = list(
+        king.generate_moves(board, king_pos)
+    )  # castling is checked by King.move
+    king_moves = []
+    board.occupied[color] &= ~(1 << king_pos)  # sliders must see through the king
+    for move_to in targets:
+        if abs((move_to & 7) - (king_pos & 7)) == 2 or not is_attacked(
+            color == "white", move_to, board
+        ):
+            king_moves.append(move_to)
+    board.occupied[color] |= 1 << king_pos
+    for move_to in king_moves:
+        yield king_pos, move_to, None
+    if checkers & (checkers - 1):  # double check, only the king can move
+        return
+
+    for square in list(board.pieces[color]):
+        if square == king_pos:
+            continue
+        piece = board.squares[square]
+        allowed = evasions & pinned.get(square, -1)
+        is_pawn = isinstance(piece, Pawn)
+        for move_to in piece.generate_moves(board, square):
             if (
-                isinstance(board.squares[square], Piece)
-                and board.squares[square].color == "black"
-                and board.squares[square].on_the_board == 1
-            ):
-                for move_to in board.squares.keys():
-                    if board.squares[square].move(
-                        board.squares[square].position, move_to, board
-                    ) != 0 and is_legal(board.squares[square].position, move_to, board):
-                        return False
-        return True
+                is_pawn
+                and (square & 7) != (move_to & 7)
+                and board.squares[move_to] == " "
+            ):  # en passant takes a pawn off the line of the king too
+                board.make_move(square, move_to)
+                legal = not is_attacked(color == "white", king_pos, board)
+                board.unmake_move()
+                if legal:
+                    yield square, move_to, None
+            elif allowed >> move_to & 1:
+                if is_pawn and (move_to >> 3 == 0 or move_to >> 3 == 7):
+                    for kind in PROMOTIONS:
+                        yield square, move_to, kind(color)
+                else:
+                    yield square, move_to, None
+
+
+def move_name(move_from: int, move_to: int, promotion=None) -> str:
+    name = square_name(move_from) + square_name(move_to)
+    if promotion != None:  # a piece or a piece class
+        name += PROMOTIONS[
+            promotion if isinstance(promotion, type) else type(promotion)
+        ]
+    return name
+
+
+def perft(board: Chessboard, depth: int) -> int:
+    if depth == 0:
+        return 1
+    if depth == 1:  # the last ply only needs counting
+        return sum(1 for move in legal_moves(board))
+    nodes = 0
+    for move in list(legal_moves(board)):
+        board.make_move(*move)
+        nodes += perft(board, depth - 1)
+        board.unmake_move()
+    return nodes
+
+
+def divide(board: Chessboard, depth: int) -> int:
+    nodes = 0
+    for move in list(legal_moves(board)):
+        board.make_move(*move)
+        count = perft(board, depth - 1)
+        board.unmake_move()
+        print(f"{move_name(*move)}: {count}")
+        nodes += count
+    return nodes
+
+
+def search_subtree(job) -> tuple:
+    task, data, move, depth = job
+    board = pickle.loads(data)  # every process works on its own copy
+    board.make_move(*move)
+    return move, task(board, depth)
+
+
+def split_root(board: Chessboard, task, depth: int, workers: int = None):
+    # Runs task(board, depth - 1) after every root move on a process pool and
+    # yields (move, result) pairs as the subtrees finish
+    data = pickle.dumps(board)
+    jobs = [(task, data, move, depth - 1) for move in legal_moves(board)]
+    with multiprocessing.Pool(workers or os.cpu_count(), uninstrument) as pool:
+        yield from pool.imap_unordered(search_subtree, jobs)
+
+
+def parallel_perft(
+    board: Chessboard, depth: int, workers: int = None, show_divide: bool = False
+) -> int:
+    if depth < 2:
+        return divide(board, depth) if show_divide == True else perft(board, depth)
+    nodes = 0
+    for move, count in split_root(board, perft, depth, workers):
+        if show_divide == True:
+            print(f"{move_name(*move)}: {count}")
+        nodes += count
+    return nodes
+
+
+def run_perft(
+    depth: int, show_divide: bool = False, fen: str = None, workers: int = 1
+) -> bool:
+    if fen != None:
+        positions = [("fen", fen, [])]
+    else:
+        positions = PERFT_POSITIONS
+    passed = True
+    total_nodes = 0
+    total_time = 0.0
+    for name, position, expected in positions:
+        board = Chessboard.from_fen(position)
+        start = time.perf_counter()
+        if show_divide == True:
+            print(f"{name}:")
+        if workers != 1:
+            nodes = parallel_perft(board, depth, workers, show_divide)
+        elif show_divide == True:
+            nodes = divide(board, depth)
+        else:
+            nodes = perft(board, depth)
+        elapsed = time.perf_counter() - start
+        total_nodes += nodes
+        total_time += elapsed
+
+        if depth <= len(expected):
+            status = "ok" if nodes == expected[depth - 1] else "MISMATCH"
+            passed = passed and nodes == expected[depth - 1]
+        else:
+            status = "-"
+        print(
+            f"{name:<12} depth {depth}  nodes {nodes:>10}  {status:<8}"
+            f"  {elapsed:8.2f}s  {nodes / max(elapsed, 1e-9):10.0f} nps"
+        )
+    print(f"total: {total_nodes} nodes, {total_nodes / max(total_time, 1e-9):.0f} nps")
+    return passed
+
+
+def read_pgn_games(path: str):
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(folder, name)
+            for folder, _, names in os.walk(path)
+            for name in names
+            if name.lower().endswith(".pgn") or name.lower().endswith(".txt")
+        )
+    else:
+        files = [path]
+    for file_name in files:
+        with open(file_name, encoding="utf-8", errors="replace") as pgn:
+            headers, movetext, index = {}, [], 0
+            for line in pgn:
+                tag = tag_pattern.match(line)
+                if tag != None:
+                    if movetext:  # a new header section starts the next game
+                        index += 1
+                        yield file_name, index, headers, "\n".join(movetext)
+                        headers, movetext = {}, []
+                    headers[tag.group(1)] = tag.group(2)
+                elif line.strip():
+                    movetext.append(line.strip())
+            if headers or movetext:
+                index += 1
+                yield file_name, index, headers, "\n".join(movetext)
+
+
+def san_to_move(board: Chessboard, san: str, moves: list = None):
+    # moves are the legal (from, to, promotion class) of the position, if known
+    if moves == None:
+        moves = [
+            (move_from, move_to, None if promotion == None else type(promotion))
+            for move_from, move_to, promotion in legal_moves(board)
+        ]
+    color = "white" if board.white_turn == True else "black"
+    san = san.rstrip("+#!?")
+    if san in ("O-O", "0-0", "O-O-O", "0-0-0"):
+        king_pos = board.king_square[color]
+        move_to = king_pos + 2 if len(san) == 3 else king_pos - 2
+        if (king_pos, move_to, None) in moves:
+            return king_pos, move_to, None
+        raise ValueError("Illegal move")
+
+    match = san_pattern.match(san)
+    if match == None:
+        raise ValueError("Invalid move")
+    letter, col, row, target, promotion = match.groups()
+    kind = FEN_PIECES[letter.lower()] if letter != None else Pawn
+    move_to = square_index(target)
+    candidates = list(
+        {
+            square
+            for square, target, promoted in moves
+            if target == move_to
+            and type(board.squares[square]) == kind
+            and (col == None or square_name(square)[0] == col)
+            and (row == None or square_name(square)[1] == row)
+        }
+    )
+    if len(candidates) != 1:  # no piece can make the move, or the SAN is ambiguous
+        raise ValueError("Illegal move")
+    if kind == Pawn and (move_to >> 3 == 0 or move_to >> 3 == 7):
+        if promotion == None:
+            raise ValueError("Missing promotion")
+        return candidates[0], move_to, FEN_PIECES[promotion.lower()]
+    return candidates[0], move_to, None
+
+
+def movetext_tokens(movetext: str) -> tuple:
+    # The SAN moves of a movetext and its termination marker
+    tokens = movetext_noise.sub(" ", movetext)
+    while "(" in tokens:  # drop variations, innermost first
+        tokens = re.sub(r"\([^()]*\)", " ", tokens)
+    tokens = tokens.split()
+    termination = "*"
+    if tokens and tokens[-1] in ("1-0", "0-1", "1/2-1/2", "*"):
+        termination = tokens.pop()
+    return tokens, termination
+
+
+replay_cache = MoveCache(16384)  # one per process, shared by the games it replays
+
+
+def replay_game(game) -> tuple:
+    file_name, index, headers, movetext = game
+    errors = []
+    tokens, termination = movetext_tokens(movetext)
+    try:
+        state = GameState(headers.get("FEN"), cache=replay_cache)
+    except ValueError:
+        return file_name, index, len(tokens), ["invalid FEN tag"]
+
+    for ply, san in enumerate(tokens):
+        try:
+            state.push(san_to_move(state.board, san, state.position()[0]))
+        except ValueError as error:
+            number = f"{ply // 2 + 1}." if ply % 2 == 0 else f"{ply // 2 + 1}..."
+            errors.append(f"{str(error).lower()} {number}{san}")
+            break
 
-    else:  # black turn
-        for square in board.squares.keys():
-            if (
-                isinstance(board.squares[square], Piece)
-                and board.squares[square].color == "white"
-                and board.squares[square].on_the_board == 1
-            ):
-                for move_to in board.squares.keys():
-                    if board.squares[square].move(
-                        board.squares[square].position, move_to, board
-                    ) != 0 and is_legal(board.squares[square].position, move_to, board):
-                        return False
+    result = headers.get("Result", termination)
+    if result != termination:
+        errors.append(f"result tag {result} but movetext ends with {termination}")
+    if not errors and state.result() != "*" and state.result() != result:
+        errors.append(f"position is {state.result()} but the result is {result}")
+    return file_name, index, len(tokens), errors
+
+
+def tally_replays(results) -> tuple:
+    # Prints the errors of the replayed games, returns games, plies and failures
+    games = plies = failed = 0
+    for file_name, index, moves, errors in results:
+        games += 1
+        plies += moves
+        if errors:
+            failed += 1
+            for error in errors:
+                print(f"{file_name} game {index}: {error}")
+    return games, plies, failed
+
+
+def run_replay(path: str, workers: int = None, chunksize: int = 64) -> bool:
+    workers = workers or os.cpu_count()
+    start = time.perf_counter()
+    if workers == 1:
+        games, plies, failed = tally_replays(map(replay_game, read_pgn_games(path)))
+    else:
+        with multiprocessing.Pool(workers, uninstrument) as pool:
+            games, plies, failed = tally_replays(
+                pool.imap_unordered(replay_game, read_pgn_games(path), chunksize)
+            )
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(
+        f"{games} games, {plies} moves, {failed} with errors, {elapsed:.2f}s,"
+        f" {games / elapsed:.0f} games/s, {plies / elapsed:.0f} moves/s"
+    )
+    return failed == 0
+
+
+RESULT_CODES = ["*", "1-0", "0-1", "1/2-1/2"]
+
+
+def selfplay_game(
+    index: int,
+    seed: int,
+    depth: int,
+    random_plies: int,
+    max_plies: int,
+    cache: MoveCache,
+    book: OpeningBook = None,
+) -> tuple:
+    # Plays one game from its own seed, so it comes out the same on any worker
+    rng = random.Random((seed << 32) + index)
+    engine = Engine(TranspositionTable(1)) if depth > 0 else None
+    player = "chess_sim engine" if depth > 0 else "random"
+    pgn = PGNWriter(
+        None,
+        {
+            "Event": "Self-play",
+            "Date": "????.??.??",
+            "Round": str(index + 1),
+            "White": player,
+            "Black": player,
+        },
+    )
+    state = GameState(cache=cache, pgn=pgn)
+    while state.result() == "*" and len(state.moves) < max_plies:
+        board = state.board
+        if (
+            board.halfmove_clock >= 100  # fifty-move rule
+            or board.repetitions() >= 3
+            or board.insufficient_material()
+        ):
+            pgn.set_result("1/2-1/2")
+            break
+        move = book.choose(state.board, rng) if book != None else None
+        if move == None:  # once out of the book a game does not come back
+            book = None
+        if move == None and engine != None and len(state.moves) >= random_plies:
+            move = engine.search(state.board, depth)[0]
+        elif move == None:  # sorted, the cached lists may come from other games
+            move = rng.choice(
+                sorted(
+                    state.legal_moves(),
+                    key=lambda move: (move[0], move[1], PROMOTION_CODES.index(move[2])),
+                )
+            )
+        state.push(move)
+    return [
+        move[0] | move[1] << 6 | PROMOTION_CODES.index(move[2]) << 12
+        for move in state.moves
+    ], pgn
+
+
+def selfplay_worker(job) -> tuple:
+    # Plays a block of games and writes them to its own buffered part file
+    path, first, last, seed, depth, random_plies, max_plies, binary, book_path = job
+    cache = MoveCache()
+    book = OpeningBook(book_path) if book_path != None else None
+    plies = 0
+    with open(path, "wb", buffering=1 << 20) as out:
+        for index in range(first, last):
+            moves, pgn = selfplay_game(
+                index, seed, depth, random_plies, max_plies, cache, book
+            )
+            plies += len(moves)
+            if binary == True:
+                result = RESULT_CODES.index(pgn.headers["Result"])
+                out.write(struct.pack(f"<HB{len(moves)}H", len(moves), result, *moves))
+            else:
+                out.write(str(pgn).encode("utf-8") + b"\n")
+    if book != None:
+        book.close()
+    return last - first, plies
+
+
+def read_selfplay_games(path: str):
+    # Reads the binary format back: yields (moves, result), with every move as
+    # (from, to, promotion class or None)
+    with open(path, "rb") as games:
+        data = games.read()
+    offset = 0
+    while offset < len(data):
+        plies, result = struct.unpack_from("<HB", data, offset)
+        codes = struct.unpack_from(f"<{plies}H", data, offset + 3)
+        offset += 3 + 2 * plies
+        moves = [
+            (code & 63, code >> 6 & 63, PROMOTION_CODES[code >> 12]) for code in codes
+        ]
+        yield moves, RESULT_CODES[result]
+
+
+def run_selfplay(
+    games: int,
+    workers: int = 1,
+    seed: int = 0,
+    depth: int = 0,
+    output: str = None,
+    binary: bool = False,
+    random_plies: int = 8,
+    max_plies: int = 400,
+    book_path: str = None,
+) -> bool:
+    if output == None:
+        output = "selfplay.bin" if binary == True else "selfplay.pgn"
+    workers = max(1, min(workers or os.cpu_count(), games))
+    bounds = [games * n // workers for n in range(workers + 1)]
+    jobs = [
+        (
+            f"{output}.part{n}",
+            bounds[n],
+            bounds[n + 1],
+            seed,
+            depth,
+            random_plies,
+            max_plies,
+            binary,
+            book_path,
+        )
+        for n in range(workers)
+    ]
+    start = time.perf_counter()
+    if workers == 1:
+        results = [selfplay_worker(jobs[0])]
+    else:
+        with multiprocessing.Pool(workers, uninstrument) as pool:
+            results = pool.map(selfplay_worker, jobs)
+    with open(output, "wb") as out:  # the parts in game order, whatever the workers
+        for job in jobs:
+            with open(job[0], "rb") as part:
+                shutil.copyfileobj(part, out)
+            os.remove(job[0])
+    elapsed = time.perf_counter() - start
+    plies = sum(result[1] for result in results)
+    print(
+        f"{games} games, {plies} plies, {elapsed:.2f}s, "
+        f"{games / elapsed:.1f} games/s, {plies / elapsed:.0f} plies/s -> {output}"
+    )
     return True
 
 
-def is_stalemate(turn: bool, board: Chessboard) -> bool:
-    if board.check == True:
-        return False
-    if turn == True:  # white turn
-        for square in board.squares.keys():
-            if (
-                isinstance(board.squares[square], Piece)
-                and board.squares[square].color == "black"
-                and board.squares[square].on_the_board == 1
-            ):
-                for move_to in board.squares.keys():
-                    if board.squares[square].move(
-                        board.squares[square].position, move_to, board
-                    ) != 0 and is_legal(board.squares[square].position, move_to, board):
-                        return False
-        return True
+def build_book(path: str, output: str = "book.bin", plies: int = 16) -> bool:
+    # Writes the first plies of the PGN games as a Polyglot book, each move
+    # weighted by the number of games that played it
+    counts = defaultdict(int)
+    games = 0
+    start = time.perf_counter()
+    for file_name, index, headers, movetext in read_pgn_games(path):
+        if "FEN" in headers:  # the book only covers games from the start
+            continue
+        state = GameState(cache=replay_cache)
+        for san in movetext_tokens(movetext)[0][:plies]:
+            try:
+                move = san_to_move(state.board, san, state.position()[0])
+            except ValueError:
+                break
+            counts[(polyglot_key(state.board), book_code(state.board, move))] += 1
+            state.push(move)
+        games += 1
+    with open(output, "wb") as out:
+        for (key, code), weight in sorted(counts.items()):
+            out.write(OpeningBook.entry.pack(key, code, min(weight, 65535), 0))
+    elapsed = time.perf_counter() - start
+    print(f"{games} games, {len(counts)} entries, {elapsed:.2f}s -> {output}")
+    return True
 
-    else:  # black turn
-        for square in board.squares.keys():
-            if (
-                isinstance(board.squares[square], Piece)
-                and board.squares[square].color == "white"
-                and board.squares[square].on_the_board == 1
-            ):
-                for move_to in board.squares.keys():
-                    if board.squares[square].move(
-                        board.squares[square].position, move_to, board
-                    ) != 0 and is_legal(board.squares[square].position, move_to, board):
-                        return False
-        return True
 
+STATUS_NAMES = ["unknown", "playing", "check", "checkmate", "stalemate"]
 
-def is_attacked(turn: bool, square: str, board: Chessboard) -> bool:
-    if turn == True:
-        for piece in board.squares.keys():
-            if (
-                isinstance(board.squares[piece], Piece)
-                and board.squares[piece].color == "black"
-                and board.squares[piece].on_the_board == 1
-            ):
-                if board.squares[piece].move(
-                    board.squares[piece].position, square, board
-                ):
-                    return True
-    else:
-        for piece in board.squares.keys():
-            if (
-                isinstance(board.squares[piece], Piece)
-                and board.squares[piece].color == "white"
-                and board.squares[piece].on_the_board == 1
-            ):
-                if board.squares[piece].move(
-                    board.squares[piece].position, square, board
-                ):
-                    return True
-    return False
 
+def server_command(state: GameState, words: list, cache: MoveCache) -> tuple:
+    # Runs one line of the protocol, returns the reply and the game to keep
+    command, args = (words[0].lower(), words[1:]) if words else ("", [])
+    try:
+        if command == "new":
+            try:
+                state = GameState(" ".join(args) or None, cache=cache)
+            except (ValueError, TypeError, IndexError):
+                raise ValueError("Invalid FEN")
+            return f"ok {state.board.to_fen()}", state
+        if command == "move" and len(args) == 1:
+            status = state.push(args[0].lower())
+            return f"ok {args[0].lower()} {STATUS_NAMES[status]}", state
+        if command == "moves":
+            return (
+                "ok " + " ".join(move_name(*move) for move in state.legal_moves()),
+                state,
+            )
+        if command == "fen":
+            return f"ok {state.board.to_fen()}", state
+        if command == "undo":
+            if not state.moves:
+                raise ValueError("Nothing to undo")
+            state.pop()
+            return f"ok {STATUS_NAMES[state.status]}", state
+        if command == "quit":
+            return "bye", state
+        raise ValueError("Unknown command")
+    except ValueError as error:
+        return f"error {error}", state
+
+
+async def serve_client(reader, writer, cache: MoveCache, idle_timeout: float):
+    state = GameState(cache=cache)  # all a connection keeps is its game
+    try:
+        while True:
+            try:
+                line = await asyncio.wait_for(reader.readline(), idle_timeout)
+            except asyncio.TimeoutError:
+                writer.write(b"bye idle\n")
+                break
+            if not line:
+                break
+            reply, state = server_command(
+                state, line.decode("utf-8", "replace").split(), cache
+            )
+            writer.write(reply.encode() + b"\n")
+            await writer.drain()
+            if reply == "bye":
+                break
+    except (ConnectionError, ValueError):  # dropped, or a line over the limit
+        pass
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+def run_server(host: str, port: int, idle_timeout: float = 300) -> None:
+    async def serve():
+        cache = MoveCache(16384)  # shared by every game, openings repeat a lot
+        server = await asyncio.start_server(
+            lambda reader, writer: serve_client(reader, writer, cache, idle_timeout),
+            host,
+            port,
+        )
+        print(f"chess_sim serving on {host}:{port}", flush=True)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+async def load_client(
+    host: str, port: int, moves: int, rng: random.Random, latencies: list
+) -> int:
+    # Plays random legal moves on one connection and times every move command
+    reader, writer = await asyncio.open_connection(host, port)
+
+    async def ask(line: str) -> str:
+        writer.write(line.encode() + b"\n")
+        await writer.drain()
+        return (await reader.readline()).decode().strip()
+
+    errors = 0
+    await ask("new")
+    for ply in range(moves):
+        legal = (await ask("moves")).split()[1:]
+        start = time.perf_counter()
+        reply = await ask("move " + rng.choice(legal))
+        latencies.append(time.perf_counter() - start)
+        if not reply.startswith("ok"):
+            errors += 1
+        elif reply.split()[-1] in ("checkmate", "stalemate"):
+            await ask("new")
+    await ask("quit")
+    writer.close()
+    await writer.wait_closed()
+    return errors
+
+
+def run_loadgen(
+    host: str, port: int, clients: int = 100, moves: int = 50, seed: int = 0
+) -> bool:
+    async def run():
+        latencies = []
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(
+                load_client(host, port, moves, random.Random(seed + n), latencies)
+                for n in range(clients)
+            ),
+            return_exceptions=True,
+        )
+        return latencies, results, time.perf_counter() - start
+
+    latencies, results, elapsed = asyncio.run(run())
+    failed = [result for result in results if isinstance(result, Exception)]
+    errors = sum(result for result in results if isinstance(result, int))
+    summary = (
+        f"{clients} clients, {len(failed)} failed, {len(latencies)} moves, "
+        f"{errors} errors, {elapsed:.2f}s, {len(latencies) / elapsed:.0f} moves/s"
+    )
+    if latencies:
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000
+        summary += f", p50 {p50:.2f} ms, p99 {p99:.2f} ms"
+    print(summary)
+    if failed:
+        print(f"first failure: {failed[0]!r}")
+    return errors == 0 and not failed
+
+
+class Profiler:
+    # Call counts and inclusive time of the wrapped functions, with one JSON
+    # line per turn holding what the turn cost and a last line with the totals
+
+    def __init__(self, path: str):
+        self.trace = open(path, "w", encoding="utf-8")
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.last_calls = {}
+        self.last_seconds = {}
+        self.originals = []  # (module or class, name, function) of what is wrapped
+
+    def wrap(self, name: str, function):
+        calls, seconds = self.calls, self.seconds
+        if inspect.isgeneratorfunction(function):
+            return self.wrap_generator(name, function)
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds[name] += time.perf_counter() - start
+                calls[name] += 1
+
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        wrapper.__wrapped__ = function
+        return wrapper
+
+    def wrap_generator(self, name: str, function):
+        # Times each step of the generator, not the code consuming it
+        calls, seconds = self.calls, self.seconds
+
+        def wrapper(*args, **kwargs):
+            calls[name] += 1
+            start = time.perf_counter()
+            iterator = function(*args, **kwargs)
+            while True:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    seconds[name] += time.perf_counter() - start
+                    return
+                seconds[name] += time.perf_counter() - start
+                yield item
+                start = time.perf_counter()
+
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        wrapper.__wrapped__ = function
+        return wrapper
+
+    def counters(self, since_last: bool = False) -> dict:
+        counters = {}
+        for name in sorted(self.calls):
+            calls, seconds = self.calls[name], self.seconds[name]
+            if since_last == True:
+                calls -= self.last_calls.get(name, 0)
+                seconds -= self.last_seconds.get(name, 0.0)
+                if calls == 0:
+                    continue
+            counters[name] = {"calls": calls, "ms": round(seconds * 1000, 3)}
+        return counters
+
+    def end_turn(self, state) -> None:
+        record = {
+            "ply": len(state.moves),
+            "move": move_name(*state.moves[-1]),
+            "status": state.status,
+            "cache": state.cache.stats(),
+            "functions": self.counters(since_last=True),
+        }
+        self.trace.write(json.dumps(record) + "\n")
+        self.trace.flush()  # a killed process keeps the turns written so far
+        self.last_calls = dict(self.calls)
+        self.last_seconds = dict(self.seconds)
+
+    def close(self) -> None:
+        self.trace.write(json.dumps({"total": self.counters()}) + "\n")
+        self.trace.close()
+
+
+PROFILED_FUNCTIONS = [
+    "legal_moves",
+    "pseudo_legal_moves",
+    "is_legal",
+    "is_attacked",
+    "move_san",
+]
+PROFILED_METHODS = [
+    (Chessboard, "make_move"),
+    (Chessboard, "unmake_move"),
+    (GameState, "position"),
+    (Engine, "evaluate"),
+    (Engine, "search"),
+] + [
+    (kind, name)
+    for kind in (Pawn, Knight, Bishop, Rook, Queen, King)
+    for name in ("generate_moves", "move")
+]
+profiler = None
+
+
+def instrument(path: str) -> Profiler:
+    # Swaps the hot functions for counting wrappers. Nothing is wrapped unless
+    # this runs, so there is no cost when profiling is off
+    global profiler
+    if profiler != None:
+        return profiler
+    profiler = Profiler(path)
+    module = globals()
+    for name in PROFILED_FUNCTIONS:
+        profiler.originals.append((None, name, module[name]))
+        module[name] = profiler.wrap(name, module[name])
+    for cls, name in PROFILED_METHODS:
+        profiler.originals.append((cls, name, getattr(cls, name)))
+        setattr(cls, name, profiler.wrap(f"{cls.__name__}.{name}", getattr(cls, name)))
+
+    push = GameState.push
+    profiler.originals.append((GameState, "push", push))
+
+    def push_and_trace(self, move, promotion=None) -> int:
+        status = push(self, move, promotion)
+        profiler.end_turn(self)
+        return status
+
+    GameState.push = push_and_trace
+    atexit.register(profiler.close)
+    return profiler
+
+
+def uninstrument() -> None:
+    # Initializer of the worker pools: forked workers inherit the wrappers and
+    # the open trace, so they put the original functions back. The profiler
+    # is kept so the copy of the trace file is never closed and flushed
+    if profiler == None:
+        return
+    atexit.unregister(profiler.close)
+    for owner, name, function in profiler.originals:
+        if owner == None:
+            globals()[name] = function
+        else:
+            setattr(owner, name, function)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Command line chess simulator")
+    parser.add_argument(
+        "--hash",
+        type=int,
+        default=16,
+        metavar="MB",
+        help="memory budget of the transposition table (default: 16)",
+    )
+    parser.add_argument(
+        "--pgn-flush",
+        type=int,
+        default=0,
+        metavar="PLIES",
+        help="append the new moves to the PGN file every PLIES moves "
+        "(default: only write it at the end)",
+    )
+    parser.add_argument(
+        "--vs-engine",
+        nargs="?",
+        const="black",
+        choices=["white", "black"],
+        help="let the engine play this colour (default: black)",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        help="search depth of the engine in plies (default: 3 without a time limit)",
+    )
+    parser.add_argument(
+        "--movetime",
+        type=int,
+        metavar="MS",
+        help="time the engine may spend on each move",
+    )
+    parser.add_argument(
+        "--clock",
+        type=int,
+        metavar="MS",
+        help="total time of the engine for the game, instead of --movetime",
+    )
+    parser.add_argument(
+        "--increment",
+        type=int,
+        default=0,
+        metavar="MS",
+        help="time added to the engine clock after each move (default: 0)",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="write call counts and timings of the hot functions to PATH as "
+        "JSON lines, one per turn (also enabled by CHESS_SIM_PROFILE=PATH)",
+    )
+    parser.add_argument(
+        "--book",
+        metavar="PATH",
+        help="let the engine play its opening moves from this Polyglot book",
+    )
+    commands = parser.add_subparsers(dest="command")
+    perft_parser = commands.add_parser(
+        "perft", help="count the leaf nodes of the move tree and measure speed"
+    )
+    perft_parser.add_argument("depth", type=int)
+    perft_parser.add_argument(
+        "--divide", action="store_true", help="print the node count of each root move"
+    )
+    perft_parser.add_argument(
+        "--fen", help="search this position instead of the built-in suite"
+    )
+    perft_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="split the root moves over this many processes, 0 for all cores",
+    )
+    replay_parser = commands.add_parser(
+        "replay", help="check the moves and results of PGN files"
+    )
+    replay_parser.add_argument("path", help="a PGN file or a folder of PGN files")
+    replay_parser.add_argument(
+        "--workers", type=int, default=None, help="processes (default: all cores)"
+    )
+    replay_parser.add_argument(
+        "--chunksize", type=int, default=64, help="games sent to a process at once"
+    )
+    selfplay_parser = commands.add_parser(
+        "selfplay", help="play complete games against itself and save them"
+    )
+    selfplay_parser.add_argument("--games", type=int, default=100)
+    selfplay_parser.add_argument(
+        "--workers", type=int, default=1, help="processes, 0 for all cores"
+    )
+    selfplay_parser.add_argument("--seed", type=int, default=0)
+    selfplay_parser.add_argument(
+        "--depth",
+        type=int,
+        default=0,
+        help="engine search depth, 0 for random moves (default: 0)",
+    )
+    selfplay_parser.add_argument(
+        "--random-plies",
+        type=int,
+        default=8,
+        help="random opening moves before the engine plays (default: 8)",
+    )
+    selfplay_parser.add_argument(
+        "--max-plies",
+        type=int,
+        default=400,
+        help="stop unfinished games after this many plies (default: 400)",
+    )
+    selfplay_parser.add_argument(
+        "--format", choices=["pgn", "bin"], default="pgn", help="(default: pgn)"
+    )
+    selfplay_parser.add_argument("--output", help="(default: selfplay.pgn or .bin)")
+    selfplay_parser.add_argument(
+        "--book", metavar="PATH", help="play the opening from this Polyglot book"
+    )
+    book_parser = commands.add_parser(
+        "make-book", help="write a Polyglot opening book from PGN files"
+    )
+    book_parser.add_argument("path", help="a PGN file or a folder of PGN files")
+    book_parser.add_argument("--output", default="book.bin", help="(default: book.bin)")
+    book_parser.add_argument(
+        "--plies", type=int, default=16, help="moves of each game kept (default: 16)"
+    )
+    serve_parser = commands.add_parser(
+        "serve", help="host games over a line protocol on a TCP port"
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=7070)
+    serve_parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=300,
+        metavar="SECONDS",
+        help="close connections that send nothing for this long (default: 300)",
+    )
+    loadgen_parser = commands.add_parser(
+        "loadgen", help="play random games against a server and measure it"
+    )
+    loadgen_parser.add_argument("--host", default="127.0.0.1")
+    loadgen_parser.add_argument("--port", type=int, default=7070)
+    loadgen_parser.add_argument(
+        "--clients", type=int, default=100, help="connections at the same time"
+    )
+    loadgen_parser.add_argument(
+        "--moves", type=int, default=50, help="moves played by each connection"
+    )
+    loadgen_parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+if os.environ.get("CHESS_SIM_PROFILE") and multiprocessing.parent_process() == None:
+    instrument(os.environ["CHESS_SIM_PROFILE"])
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.profile != None:
+        instrument(args.profile)
+    if args.command == "perft":
+        passed = run_perft(args.depth, args.divide, args.fen, args.workers or None)
+        sys.exit(0 if passed else 1)
+    elif args.command == "replay":
+        sys.exit(0 if run_replay(args.path, args.workers, args.chunksize) else 1)
+    elif args.command == "selfplay":
+        passed = run_selfplay(
+            args.games,
+            args.workers,
+            args.seed,
+            args.depth,
+            args.output,
+            args.format == "bin",
+            args.random_plies,
+            args.max_plies,
+            args.book,
+        )
+        sys.exit(0 if passed else 1)
+    elif args.command == "make-book":
+        sys.exit(0 if build_book(args.path, args.output, args.plies) else 1)
+    elif args.command == "serve":
+        run_server(args.host, args.port, args.idle_timeout)
+    elif args.command == "loadgen":
+        passed = run_loadgen(args.host, args.port, args.clients, args.moves, args.seed)
+        sys.exit(0 if passed else 1)
+    else:
+        main(
+            args.hash,
+            args.pgn_flush,
+            args.vs_engine,
+            args.depth,
+            args.movetime,
+            args.clock,
+            args.increment,
+            args.book,
+        )
@@ -0,0 +1,140 @@
+import pytest
+
+from chess_sim import (
+    PERFT_POSITIONS,
+    Chessboard,
+    GameState,
+    King,
+    legal_moves,
+    polyglot_key,
+    run_replay,
+    square_index,
+)
+
+
+def walk(board: Chessboard, depth: int) -> int:
+    # Checks the incremental key at every node and that unmake_move restores
+    # the position, returns the number of leaves
+    assert board.key == board.compute_key()
+    if depth == 0:
+        return 1
+    key, fen = board.key, board.to_fen()
+    leaves = 0
+    for move_from, move_to, promotion in list(legal_moves(board)):
+        board.make_move(move_from, move_to, promotion)
+        leaves += walk(board, depth - 1)
+        board.unmake_move()
+        assert board.key == key
+        assert board.to_fen() == fen
+    return leaves
+
+
+@pytest.mark.parametrize(
+    "name, fen, expected", PERFT_POSITIONS, ids=[p[0] for p in PERFT_POSITIONS]
+)
+def test_incremental_key(name, fen, expected):
+    assert walk(Chessboard.from_fen(fen), 3) == expected[2]
+
+
+POLYGLOT_KEYS = [  # the test positions of the Polyglot book format
+    ("", 0x463B96181691FC9C),
+    ("e2e4", 0x823C9B50FD114196),
+    ("e2e4 d7d5", 0x0756B94461C50FB0),
+    ("e2e4 d7d5 e4e5", 0x662FAFB965DB29D4),
+    ("e2e4 d7d5 e4e5 f7f5", 0x22A48B5A8E47FF78),
+    ("e2e4 d7d5 e4e5 f7f5 e1e2", 0x652A607CA3F242C1),
+    ("e2e4 d7d5 e4e5 f7f5 e1e2 e8f7", 0x00FDD303C946BDD9),
+    ("a2a4 b7b5 h2h4 b5b4 c2c4", 0x3C8123EA7B067637),
+    ("a2a4 b7b5 h2h4 b5b4 c2c4 b4c3 a1a3", 0x5C3F9B829B279560),
+]
+
+
+@pytest.mark.parametrize("moves, key", POLYGLOT_KEYS)
+def test_polyglot_key(moves, key):
+    state = GameState()
+    for move in moves.split():
+        state.push((square_index(move[:2]), square_index(move[2:]), None))
+    assert polyglot_key(state.board) == key
+
+
+@pytest.mark.parametrize(
+    "fen",
+    [
+        "4k3/8/8/8/8/8/8/4K3 w - - 0",  # five fields
+        "4k3/ppppppppp/8/8/8/8/8/4K3 w - - 0 1",  # nine files in a rank
+        "4k3/8/8/8/8/8/8/K6 w - - 0 1",  # seven files in a rank
+        "4k3/8/8/8/8/8/8/4K3/8 w - - 0 1",  # nine ranks
+        "4k3/8/8/8/8/8/4K3 w - - 0 1",  # seven ranks
+        "4k3/8/8/8/8/8/8/4X3 w - - 0 1",  # unknown piece
+        "4k3/8/8/8/8/8/8/8 w - - 0 1",  # no white king
+        "K7/8/8/8/8/8/8/K7 w - - 0 1",  # two white kings and no black one
+        "4k3/8/8/8/8/8/8/4K3 x - - 0 1",  # side to move
+        "4k3/8/8/8/8/8/8/4K3 w KX - 0 1",  # castling field
+        "4k3/8/8/8/8/8/8/4K3 w - e9 0 1",  # en passant square
+        "4k3/8/8/8/4P3/8/8/4K3 w - e3 0 1",  # en passant rank, white to move
+        "4k3/8/8/4p3/8/8/8/4K3 b - e6 0 1",  # en passant rank, black to move
+        "4k3/4R3/8/8/8/8/8/4K3 w - - 0 1",  # black is in check with white to move
+    ],
+)
+def test_from_fen_rejects(fen):
+    with pytest.raises(ValueError, match="Invalid FEN"):
+        Chessboard.from_fen(fen)
+
+
+def test_from_fen_accepts_en_passant():
+    fen = "4k3/8/8/8/3pP3/8/8/4K3 b - e3 0 1"
+    assert Chessboard.from_fen(fen).to_fen() == fen
+
+
+def test_push_takes_moves_from_legal_moves():
+    # legal_moves() yields promotions as pieces, GameState keeps classes
+    state = GameState("1n5k/P7/8/8/8/8/8/K7 w - - 0 1")
+    moves = list(legal_moves(state.board))
+    assert len(moves) == 11
+    for move in moves:
+        state.push(move)
+        assert state.pop() == (move[0], move[1], move[2] and type(move[2]))
+    with pytest.raises(ValueError):
+        state.push((48, 56, King))
+
+
+def test_replay_reports_a_bad_fen_tag(tmp_path, capsys):
+    path = tmp_path / "games.pgn"
+    path.write_text(
+        '[FEN "4k3/ppppppppp/8/8/8/8/8/4K3 w - - 0 1"]\n\n1. Kd2 *\n\n'
+        '[Result "1-0"]\n\n1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0\n'
+    )
+    assert run_replay(str(path), workers=1) == False
+    output = capsys.readouterr().out
+    assert "game 1: invalid FEN tag" in output
+    assert "game 2" not in output
+    assert output.splitlines()[-1].startswith("2 games, 8 moves, 1 with errors")
+
+
+@pytest.mark.parametrize(
+    "fen, drawn",
+    [
+        ("4k3/8/8/8/8/8/8/4K3 w - - 0 1", True),  # bare kings
+        ("4k3/8/8/8/8/8/8/4KN2 w - - 0 1", True),
+        ("4k3/8/8/8/8/8/8/2B1K3 w - - 0 1", True),
+        ("4kb2/8/8/8/8/8/8/2B1K3 w - - 0 1", True),  # bishops on dark squares
+        ("3kb3/8/8/8/8/8/8/2B1K3 w - - 0 1", False),  # bishops of both colours
+        ("4k3/8/8/8/8/8/8/3NKN2 w - - 0 1", False),
+        ("4kn2/8/8/8/8/8/8/2B1K3 w - - 0 1", False),
+        ("4k3/8/8/8/8/8/8/4K2R w - - 0 1", False),
+        ("4k3/7p/8/8/8/8/8/4K3 w - - 0 1", False),
+    ],
+)
+def test_insufficient_material(fen, drawn):
+    assert Chessboard.from_fen(fen).insufficient_material() == drawn
+
+
+def test_repetitions():
+    state = GameState()
+    shuffle = ["g1f3", "g8f6", "f3g1", "f6g8"]
+    for move in shuffle * 2:
+        assert state.board.repetitions() < 3
+        state.push(move)
+    assert state.board.repetitions() == 3
+    state.push("e2e4")  # a pawn move makes the earlier positions unreachable
+    assert state.board.repetitions() == 1